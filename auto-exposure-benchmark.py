@@ -0,0 +1,85 @@
+import data_coolection as cool
+import numpy
+import time
+try:
+    import scipy.ndimage
+except ImportError:
+    scipy = None
+
+# Count triggers and wall time to converge for the camera auto exposure,
+# on synthetic frames of a light spot with hot pixels, for large and small
+# spots. Compares the old median filter loop with robust_max and
+# estimate_exposure, e.g.
+# python auto-exposure-benchmark.py
+
+saturation = 2**12 - 1
+target = 0.5
+exposure_min = 0.0003
+exposure_max = 1.0
+start_exposure = 0.15
+shape = (1216, 1936)  # Manta G-235
+spot_sigmas = [80.0, 20.0, 8.0]  # Pixels
+max_triggers = 20
+rng = numpy.random.default_rng(0)
+
+y, x = numpy.mgrid[0:shape[0], 0:shape[1]]
+hot = (rng.integers(0, shape[0], 50), rng.integers(0, shape[1], 50))
+
+
+def make_spot(sigma):
+    return(numpy.exp(-((y - 500)**2 + (x - 700)**2) / (2 * sigma**2)))
+
+
+def frame(spot, brightness, exposure):
+    """ Counts for a spot with peak brightness counts per second """
+    counts = brightness * exposure * spot + rng.normal(20, 3, shape)
+    counts[hot] = saturation
+    return(numpy.clip(counts, 0, saturation).astype(numpy.uint16))
+
+
+def old_step(data, exposure):
+    """ The median filter loop the devices used before """
+    sm = scipy.ndimage.median_filter(data, 9).max()
+    autoset = min(max(exposure * (saturation * target) / sm, exposure_min), exposure_max)
+    done = (autoset >= exposure_max or autoset <= exposure_min
+            or (autoset / exposure > (1 / 1.5) and autoset / exposure < 1.5))
+    return(done, autoset)
+
+
+def new_step(data, exposure):
+    level = cool.robust_max(data, step=2)
+    if cool.exposure_converged(level, saturation, target):
+        return(True, exposure)
+    autoset = cool.estimate_exposure(exposure, level, saturation, target, exposure_min, exposure_max)
+    return(numpy.isclose(autoset, exposure), autoset)
+
+
+def converge(step, spot, brightness):
+    """ Triggers and seconds spent in step to converge, and the resulting peak level """
+    exposure = start_exposure
+    seconds = 0
+    for n in range(1, max_triggers + 1):
+        data = frame(spot, brightness, exposure)
+        tzero = time.time()
+        done, exposure = step(data, exposure)
+        seconds += time.time() - tzero
+        if done:
+            break
+    level = spot.max() * brightness * exposure / saturation
+    return(n, seconds, level)
+
+
+steps = [('robust', new_step)]
+if scipy:
+    steps.insert(0, ('median filter', old_step))
+else:
+    print('No scipy, skipping the median filter loop')
+
+for sigma in spot_sigmas:
+    spot = make_spot(sigma)
+    print('Spot sigma {0:.0f} pixels'.format(sigma))
+    for brightness in [1e3, 1e4, 1e5, 1e6, 1e7]:
+        for name, step in steps:
+            n, seconds, level = converge(step, spot, brightness)
+            print('{0:8.0e} counts/s {1:14s} {2:3d} triggers {3:8.3f} s, peak at {4:5.2f} of saturation'.format(
+                brightness, name, n, seconds, level))
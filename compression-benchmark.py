@@ -0,0 +1,46 @@
+import data_coolection as cool
+import h5py
+import sys
+import time
+
+# Measure write time and compression ratio of the compression profiles on
+# datasets from existing event files, e.g.
+# python compression-benchmark.py /var/data/ocl/2019-05-22/0000000000000042-HV1.h5
+
+profiles = ['none', 'gzip-1', 'gzip', 'gzip-9', 'lz4', 'zstd', 'zstd-9',
+            'blosc-lz4-byteshuffle', 'blosc-lz4-bitshuffle',
+            'blosc-zstd-byteshuffle', 'blosc-zstd-bitshuffle']
+repeats = 5
+
+
+def find_datasets(h5f):
+    found = []
+    h5f.visititems(lambda name, obj: found.append(name)
+                   if isinstance(obj, h5py.Dataset) and obj.ndim > 0 else None)
+    return(found)
+
+
+def benchmark(data, profile):
+    """ Write data to an in-memory file, return seconds per write and compression ratio """
+    kwargs = cool.compression_kwargs(profile)
+    tzero = time.time()
+    for n in range(repeats):
+        with h5py.File('bench-{0}.h5'.format(n), 'w', driver='core', backing_store=False) as h5f:
+            ds = h5f.create_dataset('data', data=data, chunks=data.shape, **kwargs)
+            stored = ds.id.get_storage_size()
+    return((time.time() - tzero) / repeats, data.nbytes / max(stored, 1))
+
+
+for fname in sys.argv[1:]:
+    with h5py.File(fname, 'r') as h5f:
+        for name in find_datasets(h5f):
+            data = h5f[name][:]
+            print('{0} {1}, {2} {3}'.format(fname, name, data.dtype, data.shape))
+            for profile in profiles:
+                try:
+                    seconds, ratio = benchmark(data, profile)
+                except RuntimeError as e:
+                    print('  {0:24s} {1}'.format(profile, e))
+                    continue
+                print('  {0:24s} {1:8.2f} ms {2:6.2f}x {3:8.1f} MB/s'.format(
+                    profile, seconds * 1e3, ratio, data.nbytes / seconds / 1e6))
@@ -17,13 +17,15 @@ cam_exposure = 0.15
 ccs_exposure = 0.05
 
 c.savedata.attrs['MeVs per proton'] = 0.5
-# Add devices
-cam = cool.Manta_cam('CAM1', 'Dummy', 50, 8.0,
-                     sw_trig=False,
-                     exposure=cam_exposure,
-                     gain=0,
-                     exposure_min=0.001,
-                     exposure_max=1.0)
+# Add devices, camera and spectrometer start up concurrently
+cam, ccs = cool.init_devices(
+    lambda: cool.Manta_cam('CAM1', 'Dummy', 50, 8.0,
+                           sw_trig=False,
+                           exposure=cam_exposure,
+                           gain=0,
+                           exposure_min=0.001,
+                           exposure_max=1.0),
+    lambda: cool.Thorlabs_spectrometer('CCS1', exposure=ccs_exposure, sw_trig=False))
 cam.enable_lens_controller()
 time.sleep(2)
 cam.savedata.attrs['photons_per_count'] = 5.7817
@@ -32,7 +34,6 @@ cam.savedata.attrs['ND filter'] = 1.0
 cam.savedata.attrs['distance_to_target'] = 1300
 c.add_device(cam)
 
-ccs = cool.Thorlabs_spectrometer('CCS1', exposure=ccs_exposure, sw_trig=False)
 c.add_device(ccs)
 
 stage = cool.LinearStage()
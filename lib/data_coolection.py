@@ -2,15 +2,25 @@ import h5py
 import epics
 import threading
 import time
-import scipy.ndimage
-import scipy.signal
 import moveStage
 import numbers
 import subprocess
 import collections
 import socket
+import queue
+import numpy
+import os
+import zlib
+import itertools
+import concurrent.futures
+import hashlib
+import json
 from ps4262 import ps4262
 from ISSI_lens_controller import EF_Controller
+try:
+    import hdf5plugin  # LZ4, Zstd and Blosc HDF5 filters
+except ImportError:
+    hdf5plugin = None
 
 
 def hush():
@@ -25,47 +35,558 @@ def hush():
 
 def val_or_retval(thing):
     """ Is this a value or a function? """
+    if(isinstance(thing, Static)):
+        return(thing.value())
     if(callable(thing)):
         return(thing())
     else:
         return(thing)
 
 
+class Static(object):
+    """
+    Attribute that only changes when a setter says so. The value or function
+    is evaluated once, and cached until invalidate() is called.
+    """
+    def __init__(self, thing):
+        self.thing = thing
+        self.invalidate()
+
+    def invalidate(self):
+        self._cached = False
+        self._value = None
+
+    def value(self):
+        if not self._cached:
+            self._value = val_or_retval(self.thing)
+            self._cached = True
+        return(self._value)
+
+
+def static_p(thing):
+    """ Static attributes are marked with Static, or plain values """
+    return(isinstance(thing, Static) or not callable(thing))
+
+
+def static_hash(snaps):
+    """ Hash of the static attributes in a list of Savedata snapshots """
+    h = hashlib.sha1()
+    for snap in snaps:
+        h.update(snap['groupname'].encode('utf8'))
+        for key in sorted(snap['static']):
+            h.update(key.encode('utf8'))
+            value = numpy.asarray(snap['static'][key])
+            if value.dtype.kind == 'O':
+                h.update(repr(snap['static'][key]).encode('utf8'))
+            else:
+                h.update((str(value.dtype) + str(value.shape)).encode('utf8'))
+                h.update(value.tobytes())
+    return(h.hexdigest()[:16])
+
+
+class PVCache(object):
+    """
+    Metadata PVs, subscribed once with auto_monitor so that values are read
+    from memory at trigger time instead of with a Channel Access round trip.
+
+    Monitors only post when the value changes, so an old update is not a
+    stale value. A value is stale when the PV is not connected, or has had
+    no monitor update since it last (re)connected. Stale values are read
+    with epics.caget instead.
+    """
+    def __init__(self):
+        self._pvs = {}
+        self._updated = {}  # pvname -> local time of the latest monitor update
+        self._lock = threading.Lock()
+        self._update_condition = threading.Condition()  # Notified on every monitor update
+
+    def _on_update(self, pvname=None, **kw):
+        with self._update_condition:
+            self._updated[pvname] = time.time()
+            self._update_condition.notify_all()
+
+    def _on_connection(self, pvname=None, conn=None, **kw):
+        if not conn:
+            # The value from before the disconnect is stale, reconnecting posts a new one
+            with self._update_condition:
+                self._updated.pop(pvname, None)
+
+    def wait_for_update(self, pvname, since, timeout):
+        """ Wait for a monitor update of pvname later than since. False on timeout """
+        self.pv(pvname)
+        deadline = time.time() + timeout
+        with self._update_condition:
+            while(self._updated.get(pvname, 0) <= since):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return(False)
+                self._update_condition.wait(remaining)
+        return(True)
+
+    def pv(self, pvname):
+        """ Monitored PV object for pvname, subscribe on first use """
+        with self._lock:
+            pv = self._pvs.get(pvname)
+            if pv is None:
+                pv = epics.PV(pvname, auto_monitor=True, callback=self._on_update,
+                              connection_callback=self._on_connection)
+                self._pvs[pvname] = pv
+        return(pv)
+
+    def fresh(self, pvname):
+        """ Can pvname be read from memory? """
+        return(self.pv(pvname).connected and pvname in self._updated)
+
+    def get(self, pvname):
+        """ Latest value of pvname, from memory if it is fresh """
+        if self.fresh(pvname):
+            return(self.pv(pvname).get(use_monitor=True))
+        return(epics.caget(pvname))
+
+    def get_many(self, pvnames):
+        """ Dict of latest values, stale ones are read with a single caget_many """
+        values = {}
+        stale = []
+        for pvname in pvnames:
+            if self.fresh(pvname):
+                values[pvname] = self.pv(pvname).get(use_monitor=True)
+            else:
+                stale.append(pvname)
+        if stale:
+            values.update(zip(stale, epics.caget_many(stale)))
+        return(values)
+
+
+pv_cache = PVCache()
+
+
+def monitored(pvname):
+    """ Attribute function reading pvname from the PV cache """
+    pv_cache.pv(pvname)
+    return(lambda: pv_cache.get(pvname))
+
+
+def put_and_wait(pvname, value, readback=None, timeout=1.0):
+    """
+    caput that returns when the record has finished processing, instead of
+    after a fixed sleep. With readback, also wait for a monitor update of the
+    readback PV, unless it already has the value. Returns seconds waited.
+    """
+    tzero = time.time()
+    if readback:
+        pv_cache.pv(readback)
+    # caput returns 1 when the put completed, -1 on timeout and None when not connected
+    if epics.caput(pvname, value, wait=True, timeout=timeout) != 1:
+        print('Put to ' + pvname + ' did not complete in ' + str(timeout) + ' s')
+    if readback:
+        current = pv_cache.get(readback)
+        if current is None or not numpy.allclose(current, value, rtol=1e-3):
+            if not pv_cache.wait_for_update(readback, tzero, max(0, tzero + timeout - time.time())):
+                print('No update of ' + readback + ' after put to ' + pvname)
+    return(time.time() - tzero)
+
+
+def preconnect(pvnames, timeout=2.0):
+    """
+    Connect all pvnames at once through the PV cache, instead of one by one
+    on first use. Returns the names that did not connect within timeout.
+    """
+    pvs = [pv_cache.pv(pvname) for pvname in pvnames]
+    deadline = time.time() + timeout
+    missing = []
+    for pv in pvs:
+        if not pv.wait_for_connection(timeout=max(0, deadline - time.time())):
+            missing.append(pv.pvname)
+    if missing:
+        print('Could not connect to ' + ', '.join(missing))
+    return(missing)
+
+
+def put_stages(stages, timeout=5.0):
+    """
+    Configure a device with a list of stages, each a list of (pvname, value).
+    The puts in a stage are issued in parallel, and all of them must complete
+    before the next stage starts. Returns the PVs whose put did not complete.
+    """
+    failed = []
+    for stage in stages:
+        pvs = []
+        for pvname, value in stage:
+            pv = pv_cache.pv(pvname)
+            pv.put(value, use_complete=True)
+            pvs.append(pv)
+        deadline = time.time() + timeout
+        while(not all(pv.put_complete for pv in pvs) and time.time() < deadline):
+            time.sleep(0.001)
+        failed += [pv.pvname for pv in pvs if not pv.put_complete]
+    if failed:
+        print('Put did not complete for ' + ', '.join(failed))
+    return(failed)
+
+
+def same_value(current, value):
+    """ Does a read back value match a setting? """
+    if current is None:
+        return(False)
+    if isinstance(value, str):
+        return(str(current) == value)
+    return(bool(numpy.all(numpy.isclose(current, value, rtol=1e-5, atol=0))))
+
+
+class Preset(object):
+    """
+    Named device configuration, applied with put_stages.
+
+    settings is a list of stages of (pvname, value) or (pvname, value,
+    readback). Only settings whose read back value differs are put. When
+    anything differs, the before puts (e.g. Acquire 0) are done first and
+    the after puts (e.g. Acquire 1, LT59:Send) last. prepare is always put
+    before the current state is read, e.g. LT59:Retrieve. The readbacks are
+    then read with caget_many once the prepare puts have completed, instead
+    of from the PV cache, which may not have the update yet.
+    """
+    def __init__(self, settings, before=(), after=(), prepare=()):
+        self.settings = [[(s[0], s[1], s[2] if len(s) > 2 else s[0]) for s in stage]
+                         for stage in settings]
+        self.before = list(before)
+        self.after = list(after)
+        self.prepare = list(prepare)
+
+    def pvnames(self):
+        """ Every PV the preset puts or reads """
+        names = [pvname for pvname, value in self.prepare + self.before + self.after]
+        for stage in self.settings:
+            for pvname, value, readback in stage:
+                names += [pvname, readback]
+        return(list(collections.OrderedDict.fromkeys(names)))
+
+    def changes(self, force=False, direct=False):
+        """
+        Stages of (pvname, value) that differ from the current state. With
+        direct, the readbacks are read from the IOC instead of the PV cache.
+        """
+        readbacks = [readback for stage in self.settings for pvname, value, readback in stage]
+        if force:
+            current = {}
+        elif direct:
+            current = dict(zip(readbacks, epics.caget_many(readbacks)))
+        else:
+            current = pv_cache.get_many(readbacks)
+        changed = [[(pvname, value) for pvname, value, readback in stage
+                    if not same_value(current.get(readback), value)]
+                   for stage in self.settings]
+        if not any(changed):
+            return([])
+        # The before puts change state too, e.g. Acquire 0 must be undone
+        forced = dict(self.before)
+        return([[(pvname, value) for pvname, value, readback in stage
+                 if not same_value(current.get(readback), value)
+                 or (pvname in forced and not same_value(forced[pvname], value))]
+                for stage in self.settings])
+
+    def apply(self, force=False):
+        """ Put what differs. Returns the names of the PVs that were changed """
+        if self.prepare:
+            put_stages([self.prepare])
+        changed = [stage for stage in self.changes(force, direct=bool(self.prepare)) if stage]
+        if not changed:
+            return([])
+        put_stages([stage for stage in [self.before] + changed + [self.after] if stage])
+        return([pvname for stage in changed for pvname, value in stage])
+
+
+def robust_max(data, step=1):
+    """
+    Saturation level of a frame or spectrum that ignores hot pixels and
+    spikes, of data downsampled by step along every axis. Spectra: the
+    maximum after a 3 point median. Frames: the brightest 3x3 block, the
+    maximum after a 3x3 minimum, so single hot pixels are rejected by size
+    and small bright spots are not. Data too short to filter gives its
+    plain maximum, nan when empty.
+    """
+    data = numpy.asarray(data)
+    data = data[(slice(None, None, step),) * data.ndim]
+    if data.size == 0:
+        return(float('nan'))
+    if data.ndim == 0 or min(data.shape[-2:]) < 3:
+        return(float(data.max()))
+    a, b, c = data[..., :-2], data[..., 1:-1], data[..., 2:]
+    if data.ndim == 1:
+        return(float(numpy.maximum(numpy.minimum(a, b), numpy.minimum(numpy.maximum(a, b), c)).max()))
+    data = numpy.minimum(numpy.minimum(a, b), c)
+    a, b, c = data[..., :-2, :], data[..., 1:-1, :], data[..., 2:, :]
+    return(float(numpy.minimum(numpy.minimum(a, b), c).max()))
+
+
+def estimate_exposure(exposure, level, saturation, target=0.5,
+                      exposure_min=0.0, exposure_max=numpy.inf, max_step=20):
+    """
+    Exposure that brings level to target * saturation, assuming the signal
+    is proportional to exposure. A saturated frame only says the signal is
+    too strong, so exposure is cut by max_step; a dark frame can at most be
+    raised by max_step.
+    """
+    if level >= 0.98 * saturation:
+        new = exposure / max_step
+    else:
+        new = exposure * min(target * saturation / max(level, 1e-9), max_step)
+    return(min(max(new, exposure_min), exposure_max))
+
+
+def exposure_converged(level, saturation, target=0.5, tolerance=0.25):
+    """ Is level within tolerance of target * saturation? """
+    return(abs(level / (target * saturation) - 1) <= tolerance)
+
+
+class ExposureController(object):
+    """
+    Closed loop exposure control during acquisition. After every readout of
+    the device, the exposure is adjusted towards the target level, within
+    exposure_min and exposure_max, so no calibration triggers are needed.
+    Attach with Coolector.control_exposure or
+    device.exposure_controller = ExposureController(device).
+    """
+    def __init__(self, device, tolerance=0.3, max_step=4):
+        self.device = device
+        self.tolerance = tolerance  # Wider than auto exposure, to not chase noise
+        self.max_step = max_step  # Largest change of exposure per readout
+        self.updates = 0
+
+    def update(self):
+        """ Look at the current readout, set a new exposure if needed. Returns it, or None """
+        dev = self.device
+        level = dev.saturation_level()
+        if numpy.isnan(level) or exposure_converged(level, dev.saturation, dev.exposure_target, self.tolerance):
+            return(None)
+        # The readout was taken at the exposure of its trigger, not the current one
+        new = estimate_exposure(dev.exposure_at_trigger(), level, dev.saturation,
+                                dev.exposure_target, dev.exposure_min, dev.exposure_max,
+                                self.max_step)
+        if numpy.isclose(new, dev.get_exposure()):
+            return(None)
+        dev.set_exposure(new)
+        self.updates += 1
+        return(new)
+
+
+class ExposureCache(object):
+    """
+    Converged exposure settings, keyed by device, sample and beam current,
+    kept in a JSON file so they survive between sessions
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.settings = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.settings = json.load(f)
+
+    def get(self, key):
+        return(self.settings.get(key))
+
+    def put(self, key, settings):
+        self.settings[key] = settings
+
+    def save(self):
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self.settings, f, indent=1, sort_keys=True)
+        os.replace(self.fname + '.tmp', self.fname)
+
+
+def init_devices(*factories):
+    """
+    Build devices concurrently, so their startup puts and connections
+    overlap. Returns the devices in the order of the factories, e.g.
+    cam, ccs = init_devices(lambda: Manta_cam('CAM1', ...),
+                            lambda: Thorlabs_spectrometer('CCS1'))
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max(1, len(factories)), initializer=epics.ca.use_initial_context) as pool:
+        jobs = [pool.submit(factory) for factory in factories]
+        return([job.result() for job in jobs])
+
+
+def compression_kwargs(profile):
+    """
+    h5py create_dataset arguments for a compression profile. Profiles are
+    'none', 'gzip' or 'gzip-<level>', 'lz4', 'zstd' or 'zstd-<level>' and
+    'blosc-<codec>-<shuffle>', where shuffle is noshuffle, byteshuffle or
+    bitshuffle, e.g. 'blosc-lz4-bitshuffle'. All but gzip need hdf5plugin.
+
+    'gzip-mt' or 'gzip-mt-<level>' is shuffle + gzip, compressed in
+    parallel by the compression pool, see write_chunks_parallel.
+    """
+    if profile in (None, 'none'):
+        return({})
+    name, _, option = profile.partition('-')
+    if name == 'gzip' and option.startswith('mt'):
+        return({'compression': 'gzip', 'compression_opts': int(option[3:] or 4),
+                'shuffle': True})
+    if name == 'gzip':
+        return({'compression': 'gzip', 'compression_opts': int(option or 4)})
+    if name not in ('lz4', 'zstd', 'blosc'):
+        raise ValueError('Unknown compression profile ' + profile)
+    if hdf5plugin is None:
+        raise RuntimeError('Compression profile ' + profile + ' needs hdf5plugin')
+    if name == 'lz4':
+        return(dict(hdf5plugin.LZ4()))
+    if name == 'zstd':
+        return(dict(hdf5plugin.Zstd(clevel=int(option or 3))))
+    cname, _, shuffle = option.partition('-')
+    shuffles = {'noshuffle': hdf5plugin.Blosc.NOSHUFFLE,
+                'byteshuffle': hdf5plugin.Blosc.SHUFFLE,
+                'bitshuffle': hdf5plugin.Blosc.BITSHUFFLE}
+    return(dict(hdf5plugin.Blosc(cname=cname or 'lz4', clevel=5,
+                                 shuffle=shuffles[shuffle or 'byteshuffle'])))
+
+
+def available_compression(profile):
+    """ Use profile if its filter is available, fall back to gzip if not """
+    try:
+        compression_kwargs(profile)
+        return(profile)
+    except RuntimeError:
+        print('hdf5plugin not found, using gzip instead of ' + profile)
+        return('gzip')
+
+
+def parallel_profile_p(profile):
+    """ Is this profile compressed by the compression pool? """
+    return(bool(profile) and profile.startswith('gzip-mt'))
+
+
+compression_threads = os.cpu_count()  # Size of the compression pool
+parallel_chunk_bytes = 2**17  # Target chunk size for parallel compression
+_compression_pool = None
+
+
+def set_compression_threads(n):
+    """ Resize the compression pool """
+    global compression_threads, _compression_pool
+    compression_threads = n
+    if _compression_pool:
+        _compression_pool.shutdown()
+        _compression_pool = None
+
+
+def compression_pool():
+    global _compression_pool
+    if _compression_pool is None:
+        _compression_pool = concurrent.futures.ThreadPoolExecutor(compression_threads)
+    return(_compression_pool)
+
+
+def parallel_chunk_shape(shape, itemsize):
+    """ Split along the first axis in chunks of about parallel_chunk_bytes """
+    row_bytes = int(numpy.prod(shape[1:])) * itemsize
+    rows = max(1, min(shape[0], parallel_chunk_bytes // max(row_bytes, 1)))
+    return((rows,) + tuple(shape[1:]))
+
+
+def compress_chunk(chunk, level):
+    """
+    Shuffle + deflate one chunk, the same way the HDF5 filter pipeline does
+    it. zlib releases the GIL, so chunks compress in parallel in a thread pool.
+    """
+    chunk = numpy.ascontiguousarray(chunk)
+    if chunk.itemsize > 1:
+        chunk = chunk.view(numpy.uint8).reshape(-1, chunk.itemsize).T
+    return(zlib.compress(chunk.tobytes(), level))
+
+
+def write_chunks_parallel(ds, data, offset, level):
+    """
+    Compress data chunk by chunk in the compression pool, then write the
+    chunks with direct chunk writes. ds must be created with the
+    compression_kwargs of a gzip-mt profile, data is written at offset and
+    fills the last data.ndim dimensions of ds.
+    """
+    data = numpy.asarray(data, dtype=ds.dtype)
+    lead = ds.ndim - data.ndim
+    chunk_shape = ds.chunks[lead:]
+    pool = compression_pool()
+    jobs = []
+    for start in itertools.product(*[range(0, n, c) for n, c in zip(data.shape, chunk_shape)]):
+        block = data[tuple(slice(s, s + c) for s, c in zip(start, chunk_shape))]
+        if block.shape != chunk_shape:
+            # Edge chunks are written full size
+            full = numpy.zeros(chunk_shape, dtype=data.dtype)
+            full[tuple(slice(0, n) for n in block.shape)] = block
+            block = full
+        jobs.append((tuple(offset[:lead]) + start, pool.submit(compress_chunk, block, level)))
+    for chunk_offset, job in jobs:
+        ds.id.write_direct_chunk(chunk_offset, job.result())
+
+
 class Dataset(object):
     """ This object sets up the saving of a HDF5 dataset """
-    def __init__(self, dsname, data_fun):
+    def __init__(self, dsname, data_fun, compression=None, stream=False):
         self.dsname = dsname  # String
         self.data = data_fun  # A function that returns data
         self.attrs = {}  # Attributes to the dataset
+        # Compression profile, see compression_kwargs. None uses the Savedata default
+        compression_kwargs(compression)
+        self.compression = compression
+        # A stream returns the rows since the previous event. Run files append
+        # them to one time series instead of storing them per trigger
+        self.stream = stream
+
+    def snapshot(self):
+        """ Evaluate data and attributes, return plain values that can be written later """
+        return({'dsname': self.dsname,
+                'data': val_or_retval(self.data),
+                'compression': self.compression or 'gzip',
+                'stream': self.stream,
+                'attrs': {key: val_or_retval(value) for key, value in self.attrs.items()}})
 
     def write(self, h5g):
-        data = val_or_retval(self.data)
-        ds = h5g.create_dataset(self.dsname, data=data, compression='gzip')
-        for key, value in self.attrs.items():
-            ds.attrs[key] = val_or_retval(value)
+        write_dataset_snapshot(h5g, self.snapshot())
 
 
 class Savedata(object):
     """ This object keeps track of things that should be saved to file for a device"""
-    def __init__(self, groupname, dev_type):
+    def __init__(self, groupname, dev_type, compression='gzip'):
         self.groupname = groupname
         self.attrs = {}  # Attr name -> attr value
         self.attrs['instrument_name'] = dev_type
         self.datasets = []  # Name, data, attrs, processor
+        compression_kwargs(compression)
+        self.compression = compression  # Default profile for datasets without one
 
     def add_dataset(self, ds):
         self.datasets.append(ds)
 
-    def write(self, h5f):
-        h5g = h5f.require_group(self.groupname)
-        # Group attributes
-        print(self.groupname)
-        for key, val in self.attrs.items():
-            # print(str(key) + ': ' + str(val_or_retval(val)) + ':' + str(val))
-            h5g.attrs[key] = val_or_retval(val)
-        # Datasets
+    def invalidate_static(self):
+        """ Evaluate Static attributes again on the next snapshot """
+        for val in self.attrs.values():
+            if isinstance(val, Static):
+                val.invalidate()
+
+    def snapshot(self):
+        """
+        Evaluate all attributes and datasets. The result holds no references to
+        lambdas, so it can be written to file after the device has moved on.
+        Static attributes and plain values go in 'static', the rest in 'attrs'.
+        """
+        datasets = []
         for dataset in self.datasets:
-            dataset.write(h5g)
+            snap = dataset.snapshot()
+            snap['compression'] = dataset.compression or self.compression
+            datasets.append(snap)
+        attrs = {}
+        static = {}
+        for key, val in self.attrs.items():
+            if static_p(val):
+                static[key] = val_or_retval(val)
+            else:
+                attrs[key] = val_or_retval(val)
+        return({'groupname': self.groupname,
+                'attrs': attrs,
+                'static': static,
+                'datasets': datasets})
+
+    def write(self, h5f):
+        write_snapshot(h5f, self.snapshot())
 
     def write_additional_meta(self, h5f, dict):
         h5g = h5f.require_group(self.groupname)
@@ -73,21 +594,706 @@ class Savedata(object):
             h5g.attrs[key] = val
 
 
+def write_dataset_snapshot(h5g, snap):
+    """ Write a snapshot from Dataset.snapshot to a group """
+    kwargs = {}
+    if numpy.ndim(snap['data']) > 0:  # Scalars can not be compressed
+        kwargs = compression_kwargs(snap['compression'])
+    # Empty arrays, e.g. a stream without new rows, have no chunks to split
+    if kwargs and parallel_profile_p(snap['compression']) and numpy.size(snap['data']) > 0:
+        data = numpy.asarray(snap['data'])
+        ds = h5g.create_dataset(snap['dsname'], shape=data.shape, dtype=data.dtype,
+                                chunks=parallel_chunk_shape(data.shape, data.itemsize), **kwargs)
+        write_chunks_parallel(ds, data, (0,) * data.ndim, kwargs['compression_opts'])
+    else:
+        ds = h5g.create_dataset(snap['dsname'], data=snap['data'], **kwargs)
+    write_dataset_attrs(ds, snap)
+
+
+def write_dataset_attrs(ds, snap):
+    """ Dataset attributes, plus the compression profile so readers know which filter to load """
+    ds.attrs['compression'] = snap['compression']
+    for key, value in snap['attrs'].items():
+        ds.attrs[key] = value
+
+
+def write_snapshot(h5f, snap, static=True):
+    """
+    Write a snapshot from Savedata.snapshot to file. Set static to False when
+    the static attributes are in a run header.
+    """
+    h5g = h5f.require_group(snap['groupname'])
+    # Group attributes
+    print(snap['groupname'])
+    for key, val in snap['attrs'].items():
+        h5g.attrs[key] = val
+    if static:
+        for key, val in snap['static'].items():
+            h5g.attrs[key] = val
+    # Datasets
+    for dataset in snap['datasets']:
+        write_dataset_snapshot(h5g, dataset)
+
+
+class AsyncWriter(object):
+    """
+    Write events to HDF5 files from a background thread.
+
+    Events are put on a bounded queue. When the queue is full, backpressure
+    decides what happens: 'block' waits for the writer to catch up,
+    'drop_oldest' throws away the oldest event that is not written yet.
+    """
+    def __init__(self, write_fun, maxsize=16, backpressure='block', discard_fun=None):
+        if backpressure not in ('block', 'drop_oldest'):
+            raise ValueError('backpressure must be block or drop_oldest')
+        self._write_fun = write_fun
+        self._discard_fun = discard_fun  # Called with events that are dropped
+        self.queue = queue.Queue(maxsize)
+        self.backpressure = backpressure
+        self.dropped = 0  # Events thrown away because the queue was full
+        self.error = None  # Latest exception from the writer thread
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while(True):
+            event = self.queue.get()
+            try:
+                if event is None:
+                    return
+                self._write_fun(event)
+            except Exception as e:
+                print('Writer thread failed: ' + str(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        """ Pass errors from the writer thread on to the trigger loop """
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise RuntimeError('Writing event failed: ' + str(error)) from error
+
+    def put(self, event):
+        """ Queue an event for writing """
+        self.raise_error()
+        self.start()
+        if self.backpressure == 'block':
+            self.queue.put(event)
+            return
+        while(True):
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    if self._discard_fun:
+                        self._discard_fun(dropped)
+                    print('Writer queue full, dropped oldest event!')
+                except queue.Empty:
+                    pass
+
+    def depth(self):
+        """ Number of events waiting to be written """
+        return(self.queue.qsize())
+
+    def flush(self):
+        """ Wait until all queued events are on disk """
+        self.queue.join()
+        self.raise_error()
+
+    def stop(self):
+        """ Write remaining events, then stop the writer thread """
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self.raise_error()
+
+
+def column_value_p(value):
+    """ Can this attribute value be stored as a per-trigger column? """
+    return(isinstance(value, (numbers.Number, str, bytes, numpy.generic)) and
+           numpy.ndim(value) == 0)
+
+
+class RunFile(object):
+    """
+    One HDF5 file for many triggers, opened in append mode.
+
+    Every Dataset becomes a chunked, resizable dataset with the trigger index
+    as first axis, e.g. data/images/CAM1/data shaped [n_triggers, Y, X].
+    Scalar group attributes are stored as per-trigger columns in an
+    event_attrs group next to the datasets, other attributes are written as
+    plain group attributes (latest value). Numeric dataset attributes are
+    columns in event_attrs/<dsname>, the others are written when the dataset
+    is created. Numeric columns are float64, so a column started with 0
+    keeps a later 2.7. Data that changes shape or kind between triggers is
+    stored one dataset per trigger in a <dsname>_ragged group.
+
+    With swmr, the file switches to single writer/multiple reader mode
+    after the first event has created all datasets, see RunFileReader.
+    From then on only rows are written: attributes are not updated and
+    new datasets are not created. SWMR can not read variable length data,
+    so string columns are fixed length, swmr_string_length bytes.
+    """
+    swmr_string_length = 256  # Longer strings are cut, with a message
+
+    def __init__(self, fname, swmr=False):
+        self.fname = fname
+        self.swmr = swmr
+        if swmr:
+            self.h5f = h5py.File(fname, 'a', libver='latest')
+        else:
+            self.h5f = h5py.File(fname, 'a')
+        if 'n_events' not in self.h5f:
+            self.h5f.create_dataset('n_events', data=[0], dtype='i8')
+        self.index = int(self.h5f['n_events'][0])  # Next trigger index
+        self.n_alloc = 0  # Preallocated number of triggers
+
+    def preallocate(self, n):
+        """ Make room for n triggers in total, set up when the trigger count is known """
+        self.n_alloc = max(self.n_alloc, n)
+
+    def _alloc_size(self, current):
+        """ Number of rows to grow a dataset to, when it is too short for the next trigger """
+        return(max(self.index + 1, self.n_alloc, 2 * current))
+
+    def _append(self, h5g, name, value, **kwargs):
+        """ Write value to row self.index of an extendable dataset, create it if needed """
+        value = numpy.asarray(value)
+        if name not in h5g:
+            if self.h5f.swmr_mode:
+                print('Can not add ' + h5g.name + '/' + name + ' to a SWMR file, skipping')
+                return(None)
+            if value.dtype.kind in 'US' and self.swmr:
+                kwargs['dtype'] = h5py.string_dtype(length=self.swmr_string_length)
+            elif value.dtype.kind in 'US':
+                kwargs['dtype'] = h5py.string_dtype()
+            elif 'dtype' not in kwargs:
+                kwargs['dtype'] = value.dtype
+            return(h5g.create_dataset(name,
+                                      shape=(max(self.index + 1, self.n_alloc),) + value.shape,
+                                      maxshape=(None,) + value.shape,
+                                      **kwargs))
+        ds = h5g[name]
+        if ds.shape[1:] != value.shape:
+            return(None)
+        if value.dtype.kind not in 'USO' and not numpy.can_cast(value.dtype, ds.dtype, 'same_kind'):
+            return(None)
+        if ds.shape[0] <= self.index:
+            ds.resize(self._alloc_size(ds.shape[0]), axis=0)
+        return(ds)
+
+    def write_column(self, h5g, name, value):
+        kwargs = {}
+        if numpy.asarray(value).dtype.kind in 'iuf':
+            kwargs['dtype'] = 'f8'  # The first value does not fix ints for later floats
+        ds = self._append(h5g, name, value, chunks=True, **kwargs)
+        if ds is not None and ds.dtype.kind == 'S':
+            value = value.encode('utf8') if isinstance(value, str) else value
+            if len(value) > ds.dtype.itemsize:
+                print('Cutting ' + h5g.name + '/' + name + ' to ' + str(ds.dtype.itemsize) + ' bytes')
+            ds[self.index] = value[:ds.dtype.itemsize]
+        elif ds is not None:
+            ds[self.index] = value
+        elif name in h5g:
+            print('Type or shape of ' + h5g.name + '/' + name + ' changed, not written')
+
+    def write_stream(self, h5g, snap):
+        """ Append the rows of a stream Dataset to its time series """
+        data = numpy.asarray(snap['data'])
+        if snap['dsname'] not in h5g:
+            if self.h5f.swmr_mode:
+                print('Can not add ' + h5g.name + '/' + snap['dsname'] + ' to a SWMR file, skipping')
+                return
+            ds = h5g.create_dataset(snap['dsname'], shape=(0,) + data.shape[1:], dtype=data.dtype,
+                                    maxshape=(None,) + data.shape[1:], chunks=True,
+                                    **compression_kwargs(snap['compression']))
+            ds.attrs['stream'] = True  # Not trimmed to the number of triggers
+            write_dataset_attrs(ds, snap)
+        ds = h5g[snap['dsname']]
+        if len(data) > 0:
+            n = ds.shape[0]
+            ds.resize(n + len(data), axis=0)
+            ds[n:] = data
+
+    def write_dataset(self, h5g, snap):
+        if snap.get('stream'):
+            self.write_stream(h5g, snap)
+            return
+        data = numpy.asarray(snap['data'])
+        parallel = parallel_profile_p(snap['compression']) and data.size > 0 and data.ndim > 0
+        chunks = True  # Also for empty arrays, chunk dimensions must be positive
+        if parallel:
+            chunks = (1,) + parallel_chunk_shape(data.shape, data.itemsize)
+        elif data.size > 0 and data.ndim > 0:
+            chunks = (1,) + data.shape
+        kwargs = compression_kwargs(snap['compression'])
+        new = snap['dsname'] not in h5g
+        ds = self._append(h5g, snap['dsname'], data, chunks=chunks, **kwargs)
+        if ds is None and self.h5f.swmr_mode:
+            return
+        if ds is None:
+            # Shape changed since the first trigger, store this one on its own
+            ragged = h5g.require_group(snap['dsname'] + '_ragged')
+            write_dataset_snapshot(ragged, dict(snap, dsname='{0:016d}'.format(self.index)))
+            return
+        if parallel:
+            write_chunks_parallel(ds, data, (self.index,) + (0,) * data.ndim,
+                                  kwargs['compression_opts'])
+        else:
+            ds[self.index] = data
+        if new:
+            write_dataset_attrs(ds, snap)
+        # Numbers change per trigger, e.g. the PicoScope capture times
+        columns = None
+        for key, val in snap['attrs'].items():
+            if column_value_p(val) and not isinstance(val, (str, bytes)):
+                columns = columns or self.require_group(h5g.name + '/event_attrs/' + snap['dsname'])
+                if columns is not None:
+                    self.write_column(columns, key, val)
+
+    def write_event(self, event):
+        """ Append an event from Coolector.snapshot_event """
+        if event['static_hash']:
+            # Empty when the header could not be added, the columns below have the values
+            header = event['static_hash'] if self.write_header(event) else ''
+            self.write_column(self.require_group('/event_attrs'), 'static_header', header)
+        for snap in event['groups']:
+            h5g = self.require_group(snap['groupname'])
+            if h5g is None:
+                print('Can not add ' + snap['groupname'] + ' to a SWMR file, skipping')
+                continue
+            columns = self.require_group(h5g.name + '/event_attrs')
+            attrs = dict(snap['attrs'])
+            # SWMR files can not get new headers, keep static values as columns from the start
+            if not event['static_hash'] or self.swmr:
+                attrs.update(snap['static'])
+            for key, val in attrs.items():
+                if column_value_p(val):
+                    self.write_column(columns, key, val)
+                elif not self.h5f.swmr_mode:
+                    h5g.attrs[key] = val
+            for dataset in snap['datasets']:
+                self.write_dataset(h5g, dataset)
+        self.write_column(self.require_group('/event_attrs'), 'desynced', event['desynced'])
+        # Rows are on disk before n_events says they are there
+        self.h5f.flush()
+        self.index += 1
+        n_events = self.h5f['n_events']
+        n_events[0] = self.index
+        n_events.flush()
+        if self.swmr and not self.h5f.swmr_mode:
+            self.h5f.swmr_mode = True
+
+    def write_header(self, event):
+        """
+        Static attributes go in /static_header/<hash>, mirroring the event
+        groups. The static_header column says which header a trigger uses.
+        Returns False if the header is not in the file.
+        """
+        name = '/static_header/' + event['static_hash']
+        if name in self.h5f:
+            return(True)
+        if self.h5f.swmr_mode:
+            print('Static attributes changed, can not add a header to a SWMR file')
+            return(False)
+        for snap in event['groups']:
+            h5g = self.h5f.require_group((name + '/' + snap['groupname'].strip('/')).rstrip('/'))
+            for key, val in snap['static'].items():
+                h5g.attrs[key] = val
+        return(True)
+
+    def require_group(self, name):
+        """ Existing group, or a new one if new objects are allowed """
+        if self.h5f.swmr_mode:
+            return(self.h5f.get(name))
+        return(self.h5f.require_group(name))
+
+    def close(self):
+        """ Trim preallocated rows that were never written, close the file """
+        if not self.h5f:
+            return
+        def trim(name, obj):
+            if(isinstance(obj, h5py.Dataset) and obj.maxshape and obj.maxshape[0] is None and
+               obj.shape[0] > self.index and not obj.attrs.get('stream')):
+                obj.resize(self.index, axis=0)
+        self.h5f.visititems(trim)
+        self.h5f.close()
+
+
+def group_path(groupname):
+    """ Absolute HDF5 path of a Savedata groupname """
+    return('/' + groupname.strip('/'))
+
+
+class WritePlan(object):
+    """
+    Group and dataset layout of an event, worked out once from an event
+    snapshot and reused for every event with the same layout: the groups to
+    create, parents first, and the create_dataset arguments for each dataset.
+    """
+    def __init__(self, event):
+        self.signature = self.event_signature(event)
+        self.groups = []
+        self.dataset_kwargs = {}  # (group path, dsname) -> create_dataset arguments
+        for snap in event['groups']:
+            path = ''
+            for part in snap['groupname'].strip('/').split('/'):
+                if part:
+                    path += '/' + part
+                    if path not in self.groups:
+                        self.groups.append(path)
+            for ds in snap['datasets']:
+                kwargs = {}
+                if numpy.ndim(ds['data']) > 0:
+                    kwargs = compression_kwargs(ds['compression'])
+                if parallel_profile_p(ds['compression']):
+                    kwargs = None  # Chunked by write_dataset_snapshot
+                self.dataset_kwargs[(group_path(snap['groupname']), ds['dsname'])] = kwargs
+
+    @staticmethod
+    def event_signature(event):
+        # Streams change length every event
+        return(tuple((snap['groupname'],
+                      tuple((ds['dsname'], None if ds.get('stream') else numpy.shape(ds['data']),
+                             ds['compression'])
+                            for ds in snap['datasets']))
+                     for snap in event['groups']))
+
+    def matches(self, event):
+        return(self.event_signature(event) == self.signature)
+
+    def write(self, h5f, event):
+        """ Write event to a new, empty file """
+        for name in self.groups:
+            h5f.create_group(name)
+        for snap in event['groups']:
+            path = group_path(snap['groupname'])
+            h5g = h5f[path]
+            for key, val in snap['attrs'].items():
+                h5g.attrs[key] = val
+            if not event['static_hash']:
+                for key, val in snap['static'].items():
+                    h5g.attrs[key] = val
+            for ds in snap['datasets']:
+                kwargs = self.dataset_kwargs[(path, ds['dsname'])]
+                if kwargs is None:
+                    write_dataset_snapshot(h5g, ds)
+                    continue
+                write_dataset_attrs(h5g.create_dataset(ds['dsname'], data=ds['data'], **kwargs), ds)
+
+
+class RunFileReader(object):
+    """
+    Follow a SWMR run file while it is written. Keep one reader open, call
+    refresh() and read the new triggers, e.g.
+
+    with RunFileReader(fname) as reader:
+        while(True):
+            for index in reader.new_events():
+                image = reader.read('data/images/CAM1/data', index)
+    """
+    def __init__(self, fname, timeout=60):
+        tzero = time.time()
+        while(True):
+            # The writer must have switched to SWMR mode before the file can be opened
+            try:
+                self.h5f = h5py.File(fname, 'r', libver='latest', swmr=True)
+                break
+            except OSError:
+                if time.time() - tzero > timeout:
+                    raise
+                time.sleep(0.1)
+        self.fname = fname
+        self.n_read = 0  # Triggers handed out by new_events
+
+    def refresh(self):
+        """ Number of triggers flushed by the writer """
+        n_events = self.h5f['n_events']
+        n_events.refresh()
+        return(int(n_events[0]))
+
+    def new_events(self):
+        """ Indices of triggers written since the last call """
+        n_events = self.refresh()
+        indices = range(self.n_read, n_events)
+        self.n_read = n_events
+        return(indices)
+
+    def read(self, name, index):
+        """ Read trigger index of a dataset or event_attrs column """
+        ds = self.h5f[name]
+        ds.refresh()
+        return(ds[index])
+
+    def close(self):
+        self.h5f.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class FrameBuffers(object):
+    """
+    Small pool of preallocated arrays for device callbacks. Callbacks copy
+    into a free slot; the slot belongs to the device until its data is
+    handed to an event, and to the event until it is written. Taking and
+    releasing a slot is O(1) under a short lock, no lock is held while
+    data is written to file.
+    """
+    def __init__(self, n):
+        self.n = n
+        self.shape = None
+        self.dtype = None
+        self._slots = []
+        self._free = []
+        self._generation = 0  # Releases from before a reallocation are ignored
+        self._lock = threading.Lock()
+
+    def _allocate(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._slots = [numpy.empty(self.shape, self.dtype) for n in range(self.n)]
+        self._free = list(range(self.n))
+        self._generation += 1
+
+    def allocate(self, shape, dtype):
+        """ Set up the slots up front, from the device geometry """
+        with self._lock:
+            if self.shape != tuple(shape) or self.dtype != numpy.dtype(dtype):
+                self._allocate(shape, dtype)
+
+    def store(self, value):
+        """
+        Copy value to a free slot. Returns the slot array and a token for
+        release(). When all slots are busy, value itself is returned with
+        the token None.
+        """
+        value = numpy.asarray(value)
+        with self._lock:
+            if value.shape != self.shape or value.dtype != self.dtype:
+                print('Allocating frame buffers for ' + str(value.shape) + ' ' + str(value.dtype))
+                self._allocate(value.shape, value.dtype)
+            if not self._free:
+                print('No free frame buffer!')
+                return(value, None)
+            index = self._free.pop()
+            token = (self._generation, index)
+            slot = self._slots[index]
+        numpy.copyto(slot, value)
+        return(slot, token)
+
+    def release(self, token):
+        """ Give a slot back to the pool """
+        if token is None:
+            return
+        with self._lock:
+            if token[0] == self._generation:
+                self._free.append(token[1])
+
+
+class NotifyingDeque(collections.deque):
+    """ deque that calls notify after every append, for queues filled by other threads """
+    def __init__(self, iterable=(), notify=None):
+        super().__init__(iterable)
+        self.notify = notify
+
+    def append(self, x):
+        super().append(x)
+        if self.notify:
+            self.notify()
+
+
+class RingBuffer(object):
+    """ Preallocated (time, value) series, the oldest rows are overwritten first """
+    def __init__(self, n):
+        self.n = n
+        self.data = numpy.zeros((n, 2))
+        self.count = 0  # Rows appended so far
+        self._lock = threading.Lock()
+
+    def append(self, t, value):
+        with self._lock:
+            self.data[self.count % self.n] = (t, value)
+            self.count += 1
+
+    def latest(self):
+        """ Time of the newest row, None if empty """
+        if self.count == 0:
+            return(None)
+        return(self.data[(self.count - 1) % self.n, 0])
+
+    def since(self, count):
+        """ Rows appended after the first count rows (at most n), and the new count """
+        with self._lock:
+            start = max(count, self.count - self.n)
+            rows = self.data[numpy.arange(start, self.count) % self.n]
+            return(rows, self.count)
+
+    def window(self, t0, t1):
+        """ Copy of the rows with t0 <= time <= t1, oldest first """
+        with self._lock:
+            if self.count <= self.n:
+                segments = [self.data[:self.count]]
+            else:
+                i = self.count % self.n
+                segments = [self.data[i:], self.data[:i]]
+            # Times increase within each segment
+            return(numpy.concatenate(
+                [s[numpy.searchsorted(s[:, 0], t0):numpy.searchsorted(s[:, 0], t1, 'right')]
+                 for s in segments]))
+
+
+class SlowControlSampler(object):
+    """
+    Background sampling of slow readbacks, e.g. the stage position or a
+    temperature that must be requested first. Every readback is polled by
+    its own thread at its own interval, into a table of latest values and a
+    history of (time, value). Events then read the latest value and its age
+    instead of waiting for the hardware, and the SlowControl device streams
+    the history to file.
+    """
+    def __init__(self, history=2**14):
+        self.history_size = history
+        self.readbacks = collections.OrderedDict()  # Name -> (function, interval)
+        self.latest = {}  # Name -> (value, time)
+        self.history = {}  # Name -> RingBuffer of (time, value), for numbers
+        self.users = 0  # start() calls not matched by stop()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def register(self, name, fun, interval=1.0):
+        """ Sample fun() every interval seconds, while the sampler runs """
+        with self._lock:
+            if name in self.readbacks:
+                return
+            self.readbacks[name] = (fun, interval)
+            self.history[name] = RingBuffer(self.history_size)
+            if self.users > 0:
+                self._start_thread(name, self._stop)
+
+    def sample(self, name):
+        """ Read name now, e.g. right after a move """
+        fun, interval = self.readbacks[name]
+        value = fun()
+        now = time.time()
+        self.latest[name] = (value, now)
+        if isinstance(value, numbers.Number):
+            self.history[name].append(now, value)
+        return(value)
+
+    def poll(self, name, stop):
+        """ Sample name until stop is set. Every start() makes a new stop Event """
+        interval = self.readbacks[name][1]
+        while(not stop.is_set()):
+            try:
+                self.sample(name)
+            except Exception as e:
+                print('Could not sample ' + name + ': ' + str(e))
+            stop.wait(interval)
+
+    def _start_thread(self, name, stop):
+        threading.Thread(target=self.poll, args=(name, stop), daemon=True).start()
+
+    def start(self):
+        """ Start sampling, calls are counted like Cool_device.connect """
+        with self._lock:
+            self.users += 1
+            if self.users > 1:
+                return
+            self._stop = threading.Event()
+            for name in self.readbacks:
+                self._start_thread(name, self._stop)
+
+    def stop(self):
+        with self._lock:
+            self.users = max(0, self.users - 1)
+            if self.users == 0:
+                self._stop.set()
+
+    def value(self, name):
+        """ Latest value of name, sampled now if the sampler is not running """
+        if self.users == 0 or name not in self.latest:
+            return(self.sample(name))
+        return(self.latest[name][0])
+
+    def age(self, name):
+        """ Seconds since name was sampled, -1 if never """
+        if name not in self.latest:
+            return(-1.0)
+        return(time.time() - self.latest[name][1])
+
+
+slow_control = SlowControlSampler()
+
+
 class Coolector(object):
     """
     Collect data from Cool devices, put them in HDF5 files.
     """
-    pause = 0.001
+    pause = 0.1  # Fallback poll interval, for devices that do not notify when they are ready
+    gather_threads = 16  # Devices that are snapshotted concurrently
     triggerID = 0
     _devices = []
 
-    latest_file_name = None
+    latest_file_name = None  # In async mode, this is the latest file the writer thread finished
 
     def __init__(self, session=None, sample=None, sample_uid=None, location=None, operator=None,
-                 description=None, sub_experiment=None, nominal_beam_current=0.0, directory=None):
+                 description=None, sub_experiment=None, nominal_beam_current=0.0, directory=None,
+                 async_write=False, write_queue_size=16, backpressure='block',
+                 file_layout='trigger', swmr=False, static_header=False, in_memory=False,
+                 event_match=None, event_tolerance=0.05, event_queue_length=4,
+                 exposure_cache=None):
         """
         Init function. Meta data as mandatory arguments.
+
+        With async_write, events are snapshotted at trigger time and written
+        to file by a background thread, see AsyncWriter for write_queue_size
+        and backpressure.
+
+        file_layout is 'trigger' for one file per trigger, 'run' for one
+        RunFile per run (with block) or 'sample' for one RunFile per run and sample.
+        With swmr, run files can be followed live with RunFileReader.
+
+        Static attributes (see Static) are evaluated once. With
+        static_header, they are also written only once: to a
+        header-<hash>.h5 file linked from each per-trigger file, or to
+        /static_header/<hash> in run files.
+
+        With in_memory, per-trigger files are assembled in memory and
+        written to disk in one sequential write, see write_event_image.
+
+        event_match turns on the event builder: every device keeps up to
+        event_queue_length readouts, and readouts are only combined into an
+        event when they match. event_match is 'timestamp' (within
+        event_tolerance seconds) or 'count' (same trigger number, from the
+        trigger times of a Raspi_trigger or PicoscopePython, see
+        set_count_reference).
+
+        Auto exposure starts from the exposure that converged last time for
+        the same device, sample and beam current, see ExposureCache. The
+        cache is kept in exposure_cache, by default exposure-cache.json in
+        directory.
         """
+        if event_match not in (None, 'timestamp', 'count'):
+            raise ValueError('event_match must be None, timestamp or count')
+        if file_layout not in ('trigger', 'run', 'sample'):
+            raise ValueError('file_layout must be trigger, run or sample')
+        if swmr and file_layout == 'trigger':
+            raise ValueError('SWMR needs the run or sample file_layout')
         if(not(sample and description and directory and sample_uid and location and
                sample_uid and operator and sub_experiment and session)):
             raise Exception('Supply sample, sample_uid, location, operator, ' +
@@ -95,6 +1301,17 @@ class Coolector(object):
         self.sample = sample
         self.sample_uid = sample_uid
         self.glob_trig = 0
+        self.ready_condition = threading.Condition()  # Notified by devices when they get data
+        self.event_match = event_match
+        self.event_tolerance = event_tolerance
+        self.event_queue_length = event_queue_length
+        self.unmatched_readouts = 0  # Readouts dropped by the event builder
+        self._gather_pool = None  # Threads for Cool_device.snapshot
+        self._gather_jobs = {}  # Device -> snapshot job that has not been collected
+        self._owners = {}  # Device -> trigger whose event still holds its readout
+        self._follow_lock = threading.Lock()  # Capture threads change exposures concurrently
+        self._session_depth = 0  # Nested with-blocks, devices stay connected until the outermost exits
+        self._exposure_checked = False  # check_exposure done for this session
 
         self.savedata = Savedata('/', 'Configuration')
         self.savedata.attrs['sample_name'] = lambda: self.sample
@@ -108,10 +1325,28 @@ class Coolector(object):
         self.savedata.attrs['trigger_id'] = lambda: self.glob_trig
         self.savedata.attrs['internal_trigger_count_debug'] = lambda: self.triggerID
         self.savedata.attrs['timestamp'] = lambda: time.time()
+        self.savedata.attrs['unmatched_readouts'] = lambda: self.unmatched_readouts
 
         self.directory = directory
         if(not self.directory.endswith('/')):
             self.directory += '/'
+        self.exposure_cache = ExposureCache(exposure_cache or self.directory + 'exposure-cache.json')
+
+        self.file_layout = file_layout
+        self.swmr = swmr
+        self.static_header = static_header
+        self.in_memory = in_memory
+        self._write_plan = None  # WritePlan for in_memory writes
+        self._run_name = None  # Set when a run starts
+        self._run_file = None  # Open RunFile, only touched when writing events
+        self._run_fname = None  # Run file name of the latest snapshot
+        self._run_events = 0  # Events snapshotted to _run_fname
+        self._expected_events = 0  # Number of events to preallocate in _run_fname
+
+        self._writer = None
+        if async_write:
+            self._writer = AsyncWriter(self.write_event, write_queue_size, backpressure,
+                                       discard_fun=self.release_event)
 
     def change_sample(self, sample, sample_uid):
         moved = False
@@ -121,9 +1356,16 @@ class Coolector(object):
         if moved:
             self.sample = sample
             self.sample_uid = sample_uid
+            self.invalidate_static()
         else:
             print('Do not know how to change samples, add a sample mover')
 
+    def invalidate_static(self):
+        """ Evaluate static attributes of the coolector and all devices again """
+        self.savedata.invalidate_static()
+        for dev in self._devices:
+            dev.savedata.invalidate_static()
+
     def check_if_ready(self):
         """
         Are all devices ready for ready out?
@@ -140,6 +1382,69 @@ class Coolector(object):
         """
         for dev in self._devices:
             dev.clear()
+        if self.event_match == 'count':
+            self.set_count_reference()
+
+    def set_count_reference(self):
+        """
+        For event_match='count': number readouts by the trigger count of the
+        highest trigger_rank device instead of by their own callbacks, so a
+        device that misses a trigger shows up as dropped readouts. A readout
+        gets the number of the latest reference trigger before its acquisition
+        timestamp, see Cool_device.count_at, so it is numbered right even when
+        the next trigger comes before it arrives. Other hardware counters count
+        the same trigger line, and are lined up with the reference here, while
+        no trigger is in flight.
+        """
+        counters = [dev for dev in self._devices if dev.trigger_rank > 0]
+        if not counters:
+            raise ValueError("event_match='count' needs a Raspi_trigger or PicoscopePython to count triggers")
+        reference = max(counters, key=lambda dev: dev.trigger_rank)
+        count = reference.trigger_number()
+        # Readouts acquired from now on have at least this number
+        reference.trigger_times.append(time.time(), count)
+        for dev in self._devices:
+            if dev.trigger_rank > 0:
+                dev.count_offset = count - dev.trigger_number()
+                dev.count_source = None
+            else:
+                dev.count_source = reference.count_at
+
+    def match_event(self):
+        """
+        Event builder: do the current readouts of all devices belong to the
+        same trigger? Readouts that are too old to match the newest one are
+        dropped, so the device moves on to its next queued readout.
+        """
+        keys = {}
+        for dev in self._devices:
+            key = dev.match_key(self.event_match)
+            if key is None and dev.matchable and dev.count_source and dev.is_ready:
+                print('Dropping readout from ' + dev.dev_type + ', acquired before the trigger count reference')
+                dev.advance()
+                self.unmatched_readouts += 1
+                return(False)
+            if key is not None:
+                keys[dev] = key
+                if dev.count_source:
+                    dev.readout_count = key
+        if len(keys) < 2:
+            return(True)
+        if self.event_match == 'count':
+            tolerance = 0
+        else:
+            tolerance = self.event_tolerance
+        newest = max(keys.values())
+        matched = True
+        for dev, key in keys.items():
+            if newest - key > tolerance:
+                print('Dropping unmatched readout from ' + dev.dev_type)
+                dev.advance()
+                # The next readout is written with an event missing a trigger
+                dev.potentially_desynced = True
+                self.unmatched_readouts += 1
+                matched = False
+        return(matched)
 
     def cd(self, dir):
         """ Change directory """
@@ -148,22 +1453,23 @@ class Coolector(object):
     def wait_for_data(self, timeout=15):
         """
         Wait until all devices are ready, then read them all out.
+        Devices notify ready_condition when they get data, so this wakes up
+        when the last one is ready.
         """
-        tzero = time.time()
-        got_data_p = False
-        while(True):
-            if(self.check_if_ready()):
-                got_data_p = True
-                break
-            if(time.time() - tzero > timeout):
-                for dev in self._devices:
-                    print(dev.dev_type + ' is ready: ' + str(dev.is_ready_p()))
-                print('Timed out while waiting for data!')
-                raise RuntimeError('Timed out while waiting for data!')
-                break
-            time.sleep(self.pause)
-        if(got_data_p):
-            self.write(self.triggerID)
+        deadline = time.time() + timeout
+        with self.ready_condition:
+            while(not (self.check_if_ready() and
+                       (self.event_match is None or self.match_event()))):
+                if self.check_if_ready():
+                    continue  # Dropped a readout, the next one is already queued
+                remaining = deadline - time.time()
+                if(remaining <= 0):
+                    for dev in self._devices:
+                        print(dev.dev_type + ' is ready: ' + str(dev.is_ready_p()))
+                    print('Timed out while waiting for data!')
+                    raise RuntimeError('Timed out while waiting for data!')
+                self.ready_condition.wait(min(self.pause, remaining))
+        self.write(self.triggerID)
 
     def sw_trigger(self):
         """
@@ -186,9 +1492,33 @@ class Coolector(object):
         if triggers > 1:
             print('Several trigger generators attached')
 
+    def queue_depth(self):
+        """ Number of events waiting for the writer thread """
+        if self._writer:
+            return(self._writer.depth())
+        return(0)
+
+    def flush(self):
+        """ Wait until all events are written to file """
+        if self._writer:
+            self._writer.flush()
+
     def write(self, trigger):
         """
-        Write meta data + device data for all connected devices
+        Write meta data + device data for all connected devices.
+        In async mode the event is only snapshotted here, and queued for the writer thread.
+        """
+        # Devices are re-armed one by one in gather, as soon as their own
+        # readout is captured
+        event = self.snapshot_event()
+        if self._writer:
+            self._writer.put(event)
+        else:
+            self.write_event(event)
+
+    def snapshot_event(self):
+        """
+        Evaluate meta data and device data for all connected devices
         """
         # Get global trigger from device, or use internal counter
         self.triggerID += 1
@@ -208,52 +1538,280 @@ class Coolector(object):
                 self.glob_trig = glob_trig
 
         # Create file, write to it
-        if pot_desync:
+        if self.file_layout != 'trigger':
+            fname = self.run_file_name()
+            if fname != self._run_fname:
+                self._run_fname = fname
+                self._run_events = 0
+            self._run_events += 1
+        elif pot_desync:
             fname = '{0}{1:016d}-{2}.h5'.format('/tmp/', trigger, 'desynced')
         else:
             fname = '{0}{1:016d}-{2}.h5'.format(self.directory, trigger, self.sample)
+        groups = [self.savedata.snapshot()] + self.gather()
+        event = {'fname': fname, 'groups': groups, 'desynced': pot_desync,
+                 'expected_events': self._expected_events, 'static_hash': None}
+        if self.static_header:
+            event['static_hash'] = static_hash(groups)
+            event['header_fname'] = '{0}header-{1}.h5'.format(self.directory, event['static_hash'])
+        return(event)
+
+    def owner(self, dev):
+        """ Trigger of the event still reading out dev, None if it is armed """
+        return(self._owners.get(dev))
+
+    def capture(self, dev, trigger):
+        """
+        Snapshot one device for the event of trigger, then re-arm it right
+        away, without waiting for the other devices
+        """
+        try:
+            snap = dev.snapshot()
+            if dev.exposure_controller:
+                try:
+                    if dev.exposure_controller.update() is not None:
+                        self.follow_exposures()
+                except Exception as e:
+                    # The snapshot is fine, and holds a frame buffer that must be released
+                    print(dev.dev_type + ' exposure control failed: ' + repr(e))
+            return(snap)
+        finally:
+            dev.advance()
+            self._owners.pop(dev, None)
+            if dev.is_ready:
+                # A trigger arrived during readout, it is ready already
+                dev.notify_ready()
+
+    def gather(self):
+        """
+        Snapshot all devices concurrently, so the slow ones (caputs, stage
+        position, subprocess calls) overlap. Every device is re-armed as soon
+        as its own snapshot is done, see capture. A device that does not
+        finish within its snapshot_timeout is written without data, and so
+        is every event that comes while it is still busy. The late snapshot
+        is never written, its frame buffer is released when it finishes.
+        A device whose snapshot raises is written without data, with
+        snapshot_failed, and the other devices are still collected.
+        """
+        if self._gather_pool is None:
+            self._gather_pool = concurrent.futures.ThreadPoolExecutor(
+                self.gather_threads, initializer=epics.ca.use_initial_context)
+        tzero = time.time()
+        jobs = []
+        groups = []
+        for dev in self._devices:
+            job = self._gather_jobs.get(dev)
+            if job is not None and not job.done():
+                print(dev.dev_type + ' is still busy with the snapshot of trigger '
+                      + str(self.owner(dev)) + '!')
+                groups.append(self.empty_group(dev, snapshot_timed_out=True))
+                continue
+            self._owners[dev] = self.triggerID
+            self._gather_jobs[dev] = self._gather_pool.submit(self.capture, dev, self.triggerID)
+            jobs.append((dev, self._gather_jobs[dev]))
+        for dev, job in jobs:
+            try:
+                groups.append(job.result(timeout=max(0, tzero + dev.snapshot_timeout - time.time())))
+                self._gather_jobs.pop(dev)
+            except concurrent.futures.TimeoutError:
+                print(dev.dev_type + ' timed out while reading data!')
+                job.add_done_callback(self.release_late)
+                groups.append(self.empty_group(dev, snapshot_timed_out=True))
+            except Exception as e:
+                print(dev.dev_type + ' failed to read data: ' + repr(e))
+                self._gather_jobs.pop(dev)
+                groups.append(self.empty_group(dev, snapshot_failed=True, snapshot_error=repr(e)))
+        return(groups)
+
+    @staticmethod
+    def empty_group(dev, **attrs):
+        """ Group written for a device that has no snapshot for the event """
+        return({'groupname': dev.savedata.groupname, 'attrs': attrs,
+                'static': {}, 'datasets': []})
+
+    @staticmethod
+    def release_late(job):
+        """ Done callback of a timed out snapshot: its event was written without it """
+        if job.cancelled() or job.exception() is not None:
+            return
+        snap = job.result()
+        if snap.get('release'):
+            snap['release']()
+
+    def run_file_name(self):
+        """
+        Name of the file the next event goes to, for the run and sample layouts
+        """
+        if self._run_name is None:
+            self._run_name = 'run-' + time.strftime('%Y%m%d-%H%M%S')
+        if self.file_layout == 'sample':
+            return('{0}{1}-{2}.h5'.format(self.directory, self._run_name, self.sample))
+        return('{0}{1}.h5'.format(self.directory, self._run_name))
+
+    def preallocate(self, n):
+        """
+        Expect n more triggers in the current run file, so datasets can be
+        allocated up front instead of grown.
+        """
+        if self.file_layout == 'trigger':
+            return
+        fname = self.run_file_name()
+        if fname != self._run_fname:
+            self._run_fname = fname
+            self._run_events = 0
+        self._expected_events = self._run_events + n
+
+    def write_event(self, event):
+        """
+        Write an event from snapshot_event to file, then give the device
+        buffers back
+        """
+        try:
+            self._write_event(event)
+        finally:
+            self.release_event(event)
+
+    def release_event(self, event):
+        """ Give the frame buffers of an event back to the devices """
+        for snap in event['groups']:
+            if snap.get('release'):
+                snap['release']()
+                snap['release'] = None
+
+    def _write_event(self, event):
+        fname = event['fname']
         print('Writing to ' + fname)
+        if self.file_layout != 'trigger':
+            if self._run_file and self._run_file.fname != fname:
+                self.close_run_file()
+            if not self._run_file:
+                self._run_file = RunFile(fname, self.swmr)
+            self._run_file.preallocate(event['expected_events'])
+            self._run_file.write_event(event)
+            self.latest_file_name = fname
+            return
+        if event['static_hash']:
+            self.write_header_file(event)
+        if self.in_memory:
+            self.write_event_image(event)
+            self.latest_file_name = fname
+            return
         with h5py.File(fname, 'w') as h5f:
             h5f.attrs['write_finished'] = False
-            self.savedata.write(h5f)
-            for dev in self._devices:
-                dev.write(h5f)
+            for snap in event['groups']:
+                write_snapshot(h5f, snap, static=not event['static_hash'])
+            self.link_header(h5f, event)
             h5f.attrs['write_finished'] = True
-        # All devices are read out, ready for new data
         self.latest_file_name = fname
-        for dev in self._devices:
-            dev.clear()
+
+    def link_header(self, h5f, event):
+        """ Point an event file to its static header file """
+        if event['static_hash']:
+            header = event['header_fname']
+            if os.path.dirname(header) == os.path.dirname(event['fname']):
+                header = os.path.basename(header)
+            h5f.attrs['static_header'] = event['static_hash']
+            h5f['static_header'] = h5py.ExternalLink(header, '/')
+
+    def write_event_image(self, event):
+        """
+        Build the event file in memory with the core driver, then write the
+        file image to disk in one go and rename it into place.
+        """
+        if self._write_plan is None or not self._write_plan.matches(event):
+            self._write_plan = WritePlan(event)
+        fname = event['fname']
+        with h5py.File(fname, 'w', driver='core', backing_store=False) as h5f:
+            h5f.attrs['write_finished'] = True
+            self._write_plan.write(h5f, event)
+            self.link_header(h5f, event)
+            h5f.flush()
+            image = h5f.id.get_file_image()
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(image)
+        os.replace(fname + '.tmp', fname)
+
+    def write_header_file(self, event):
+        """ Write the static attributes of an event to its header file, unless it exists """
+        fname = event['header_fname']
+        if os.path.exists(fname):
+            return
+        print('Writing header ' + fname)
+        with h5py.File(fname + '.tmp', 'w') as h5f:
+            h5f.attrs['static_header'] = event['static_hash']
+            for snap in event['groups']:
+                write_snapshot(h5f, {'groupname': snap['groupname'], 'attrs': {},
+                                     'static': snap['static'], 'datasets': []})
+        os.replace(fname + '.tmp', fname)
+
+    def close_run_file(self):
+        """ Close the open run file, if any """
+        if self._run_file:
+            self._run_file.close()
+            self._run_file = None
 
     def add_device(self, device):
         """
         Add a Cool_device to the coolector.
         """
+        device.ready_condition = self.ready_condition
+        if self.event_match:
+            device.set_queue_length(self.event_queue_length)
         self._devices.append(device)
 
     def __enter__(self):
-        """ Connect devices """
+        """
+        Connect devices. With-blocks can be nested: a scan keeps one session
+        open, and the wait_for_n_triggers calls inside it reuse the connected
+        monitors and the open run file.
+        """
         if(self.directory == '/tmp/'):
             print('Saving to tmp!!!')
+        self._session_depth += 1
+        if self._session_depth > 1:
+            return(self)
+        self._exposure_checked = False
         for dev in self._devices:
             dev.connect()
         self.clear()
         return(self)
 
     def __exit__(self, type, value, traceback):
-        """ Disconnect devices """
+        """ Disconnect devices when the outermost with-block exits """
+        self._session_depth -= 1
+        if self._session_depth > 0:
+            return
         if(self.directory == '/tmp/'):
             print('Saving to tmp!!!')
+        self.flush()
+        self.close_run_file()
+        self._run_name = None
+        self._expected_events = 0
         for dev in self._devices:
             dev.disconnect()
 
+    def settle(self, quiet=0.2, timeout=5):
+        """
+        Get rid of stale data: wait until no device has produced data for
+        quiet seconds (or timeout), then clear all devices.
+        """
+        deadline = time.time() + timeout
+        with self.ready_condition:
+            while(time.time() < deadline):
+                if not self.ready_condition.wait(min(quiet, max(0, deadline - time.time()))):
+                    break
+        self.clear()
+
     # Scans
     def wait_for_n_triggers(self, n, SW_trigger=False, pause=False):
         with self as c:
-            for dev in self._devices:
-                dev.check_exposure()
-            time.sleep(2.0)
-            for dev in self._devices:
-                dev.clear()
+            self.preallocate(n)
+            if not self._exposure_checked:
+                exposures = self.device_exposures()
+                for dev in self._devices:
+                    dev.check_exposure(exposures)
+                self._exposure_checked = True
+            self.settle()
             for trig in range(n):
                 if(SW_trigger):
                     self.sw_trigger()
@@ -266,34 +1824,98 @@ class Coolector(object):
                 if pause:
                     time.sleep(pause)
 
-    def do_auto_exposure(self):
+    def control_exposure(self, enable=True, **kw):
+        """
+        Adjust exposure between triggers for all devices that support auto
+        exposure, see ExposureController. Scans then skip auto exposure for
+        these devices.
+        """
         for dev in self._devices:
-            dev.auto_exposure(self.hw_trigger)
+            if dev.saturation is not None:
+                dev.exposure_controller = ExposureController(dev, **kw) if enable else None
+
+    def exposure_key(self, dev):
+        """ Exposure cache key for dev at the current sample and beam current """
+        beam_current = val_or_retval(self.savedata.attrs['nominal_beam_current'])
+        return('{0} {1}/{2}/{3:g}'.format(dev.dev_type, dev.port, self.sample, beam_current))
+
+    def device_exposures(self):
+        """ Exposure times of the devices that have one """
+        return([dev.get_exposure() for dev in self._devices if dev.exposure_pv])
+
+    def follow_exposures(self):
+        """ Devices without auto exposure follow the others, e.g. the Picoscope capture window """
+        with self._follow_lock:
+            exposures = self.device_exposures()
+            for dev in self._devices:
+                if dev.saturation is None:
+                    dev.follow_exposure(exposures)
+
+    def do_auto_exposure(self, trigger_fun=None, max_triggers=10):
+        """
+        Auto exposure for all devices at once: every trigger feeds all
+        devices that are not converged yet, and each updates its exposure
+        from the same shot. Devices start from the cached exposure, if there
+        is one, so the first trigger only verifies it. The other devices
+        then follow the new exposures, e.g. the Picoscope capture window.
+        Returns the number of triggers used.
+        """
+        if trigger_fun is None:
+            trigger_fun = self.hw_trigger
+        pending = [dev for dev in self._devices
+                   if dev.saturation is not None and dev.exposure_controller is None]
+        for dev in pending:
+            cached = self.exposure_cache.get(self.exposure_key(dev))
+            if cached:
+                print('Starting ' + dev.dev_type + ' from cached ' + str(cached))
+                dev.restore_exposure_settings(cached)
+        converged = []
+        n = 0
+        with self:
+            while(pending and n < max_triggers):
+                n += 1
+                self.clear()
+                trigger_fun()
+                for dev in pending:
+                    dev.wait_until_ready()
+                converged += [dev for dev in pending if dev.auto_exposure_step()]
+                pending = [dev for dev in pending if dev not in converged]
+            self.clear()
+        for dev in pending:
+            print(dev.dev_type + ' did not converge in ' + str(max_triggers) + ' triggers, not cached')
+        # Only converged exposures are a good start for next time
+        for dev in converged:
+            self.exposure_cache.put(self.exposure_key(dev), dev.exposure_settings())
+        self.exposure_cache.save()
+        self.follow_exposures()
+        print('Auto exposure done in ' + str(n) + ' triggers.')
+        self._exposure_checked = False
+        return(n)
 
     def stage_scan_n_triggers(self, n, sample_dict, auto_exposure=False, skip_dark_nb=False):
-        for sample, position in sample_dict.items():
-            self.change_sample(sample, 'NA')
-            dark_frame = (sample == 'DARK_NOBEAM') or (sample == 'DARK_BEAM')
-            if not(skip_dark_nb and (sample == 'DARK_NOBEAM')):
-                # Auto exposure
-                if auto_exposure and not dark_frame:
-                    for dev in self._devices:
-                        dev.auto_exposure(self.hw_trigger)
-                # Get triggers
-                self.wait_for_n_triggers(n)
-                if sample == 'DARK_NOBEAM':
-                    input('Press Enter to continue')
+        # One session for the whole scan, devices stay connected between samples
+        with self:
+            for sample, position in sample_dict.items():
+                self.change_sample(sample, 'NA')
+                dark_frame = (sample == 'DARK_NOBEAM') or (sample == 'DARK_BEAM')
+                if not(skip_dark_nb and (sample == 'DARK_NOBEAM')):
+                    # Auto exposure
+                    if auto_exposure and not dark_frame:
+                        self.do_auto_exposure()
+                    # Get triggers
+                    self.wait_for_n_triggers(n)
+                    if sample == 'DARK_NOBEAM':
+                        input('Press Enter to continue')
 
     def heat_scan_sample(self, sample, auto_exposure=False, pause=5):
-        self.change_sample(sample, 'NA')
-        # Auto exposure
-        if auto_exposure:
-            for dev in self._devices:
-                dev.auto_exposure(self.hw_trigger)
-            for dev in self._devices:
-                dev.auto_exposure(self.hw_trigger)
-        # Get triggers
-        self.wait_for_n_triggers(99999, SW_trigger=False, pause=pause)
+        with self:
+            self.change_sample(sample, 'NA')
+            # Auto exposure
+            if auto_exposure:
+                self.do_auto_exposure()
+                self.do_auto_exposure()
+            # Get triggers
+            self.wait_for_n_triggers(99999, SW_trigger=False, pause=pause)
 
 
 class Cool_device(object):
@@ -306,15 +1928,38 @@ class Cool_device(object):
     data = None
     timestamp = False
     triggercount = 0
+    compression = 'gzip'  # Default compression profile for the device datasets
+    ready_condition = None  # Set by Coolector.add_device
+    snapshot_timeout = 10  # Seconds Coolector.gather waits for snapshot
+    n_buffers = 3  # Frame buffers: current readout, one pending trigger, one being written
+    max_pending = 1  # Triggers that can arrive before readout without being lost
+    readout_count = 0  # triggercount when the current readout arrived
+    connections = 0  # connect() calls not matched by disconnect()
+    completion_wait = 0.0  # Seconds waited for the hardware since the previous snapshot
+    startup_time = 0.0  # Seconds from __init__ until configure was done
+    preset = ''  # Name of the configuration preset in use
+    matched_queue = False  # Set by set_queue_length, the event builder checks queued readouts
+    trigger_rank = 0  # Preference as trigger number reference for event_match='count', 0 for none
+    trigger_times = None  # RingBuffer of (time, trigger number), for devices with a trigger_rank
+    count_source = None  # Set by Coolector.set_count_reference, trigger number of a readout time
+    count_offset = 0  # Lines up the trigger_number of this device with the reference
 
     def __init__(self, port, pathname, dev_type, callback_pvname):
+        self._init_started = time.time()
         self.connected_pvs = []
+        self.buffers = FrameBuffers(self.n_buffers)
+        self._slot = None  # Buffer token of self.data
+        # (data, timestamp, triggercount, token) waiting for readout
+        self._pending = collections.deque()
+        self._readout_lock = threading.Lock()
+        # Devices with a data callback take part in event matching, see match_key
+        self.matchable = callback_pvname is not None
         # EPICS port, something like CAM1, CCS1. For non epics devices, make something up.
         self.port = port
         self._callback_pvname = callback_pvname  # Set to None for non-epivs devices
         self.dev_type = dev_type  # Descriptor for the device.
 
-        self.savedata = Savedata(pathname, dev_type)
+        self.savedata = Savedata(pathname, dev_type, available_compression(self.compression))
         if self.timestamp:
             self.savedata.attrs['timestamp'] = lambda: self.timestamp
         else:
@@ -322,15 +1967,96 @@ class Cool_device(object):
         self.savedata.attrs['trigger_count_debug'] = lambda: self.triggercount
         self.savedata.attrs['Potentially desynced'] = lambda: self.potentially_desynced
         self.savedata.attrs['acquire_duration'] = 0
+        self.savedata.attrs['readout_timestamp'] = lambda: self.timestamp or 0.0
+        self.savedata.attrs['readout_count'] = lambda: self.readout_count
+        self.savedata.attrs['completion_wait'] = lambda: self.completion_wait
+        self.savedata.attrs['startup_time'] = Static(lambda: self.startup_time)
+        self.savedata.attrs['preset'] = Static(lambda: self.preset)
+        self.presets = {}  # Name -> Preset
+        self.exposure_log = collections.deque(maxlen=64)  # (triggercount, exposure) after changes
+        self.slow_readbacks = []  # slow_control names, sampled while connected
+
+    def use_preset(self, name, force=False):
+        """
+        Switch to a configuration preset, only putting what differs from
+        the current state. With force, everything is put.
+        """
+        preset = self.presets[name]
+        changed = preset.apply(force)
+        if changed:
+            print(self.dev_type + ' preset ' + name + ' changed ' + ', '.join(changed))
+        self.preset = name
+        self.savedata.invalidate_static()
+        return(changed)
+
+    def configure(self, name, readbacks=()):
+        """
+        Startup configuration: connect every PV the device uses at once,
+        then switch to preset name
+        """
+        preconnect(self.presets[name].pvnames() + list(readbacks))
+        self.use_preset(name)
+        self.startup_time = time.time() - self._init_started
+        print(self.dev_type + ' started in ' + str(round(self.startup_time, 3)) + ' s')
+
+    def wait_for_put(self, pvname, value, readback=None, timeout=1.0):
+        """ put_and_wait, adding the time waited to completion_wait for the next event """
+        waited = put_and_wait(pvname, value, readback, timeout)
+        self.completion_wait += waited
+        return(waited)
+
+    def set_queue_length(self, n):
+        """ Keep up to n triggers waiting for readout """
+        self.clear()
+        self.matched_queue = True
+        self.max_pending = n
+        self.n_buffers = n + 2
+        self.buffers = FrameBuffers(self.n_buffers)
+
+    def match_key(self, mode):
+        """
+        Timestamp or trigger count of the current readout, for matching
+        readouts to events. None if the device does not take part.
+        """
+        if not self.matchable:
+            return(None)
+        if mode == 'timestamp':
+            return(self.timestamp or None)
+        if self.count_source:
+            return(self.count_source(self.timestamp))
+        return(self.readout_count)
 
     def get_glob_trigger(self):
         return(None)
 
+    def trigger_number(self):
+        """ Triggers counted by the device hardware, for devices with a trigger_rank """
+        return(None)
+
+    def count_at(self, t):
+        """
+        Number of the latest trigger at or before time t, from trigger_times.
+        None if t is before every trigger time kept.
+        """
+        if not t:
+            return(None)
+        rows, count = self.trigger_times.since(0)
+        rows = rows[rows[:, 0] <= t]
+        if len(rows) == 0:
+            return(None)
+        return(int(rows[-1, 1]))
+
     def move_to_sample(self, sample):
         return(False)
 
     def connect(self):
         # Set is_ready to True when there is new data using a callback
+        # Connections are counted, so auto_exposure inside a session keeps the monitor
+        self.connections += 1
+        if self.connections > 1:
+            return(self)
+        if self.slow_readbacks:
+            slow_control.start()
         print('Connecting ' + self.dev_type)
         if(self._callback_pvname):
             print('Connecting ' + self._callback_pvname)
@@ -340,19 +2066,130 @@ class Cool_device(object):
             self.connected_pvs.append(pv)
         return(self)
 
+    def sample_slowly(self, attr, name, fun, interval=1.0):
+        """
+        Read fun in the background with slow_control, write the latest
+        value to attribute attr and its age to attr + '_age'
+        """
+        slow_control.register(name, fun, interval)
+        self.slow_readbacks.append(name)
+        self.savedata.attrs[attr] = lambda: slow_control.value(name)
+        self.savedata.attrs[attr + '_age'] = lambda: slow_control.age(name)
+
     def disconnect(self):
+        self.connections = max(0, self.connections - 1)
+        if self.connections > 0:
+            return
+        if self.slow_readbacks:
+            slow_control.stop()
         for pv in self.connected_pvs:
             pv.disconnect()
         self.connected_pvs = []
 
-    def check_exposure(self):
+    def check_exposure(self, exposures=None):
+        """ See if exposure settings are ok, given the exposures of the other devices """
         pass
 
-    def auto_exposure(self, trigger_fun):
-        """Do auto exposure. Trigger fun should give a single trigger working with
-        the configured device."""
+    def follow_exposure(self, exposures):
+        """ Adapt to the exposures of the other devices, e.g. a capture window """
         pass
 
+    # Auto exposure, for devices that set saturation and exposure_pv
+    saturation = None  # Counts at saturation
+    exposure_pv = None  # Readback of the exposure time
+    exposure_target = 0.5  # Aim for this fraction of saturation
+    exposure_tolerance = 0.25  # Relative deviation from the target that is good enough
+    exposure_min = 0.0
+    exposure_max = numpy.inf
+    exposure_controller = None  # ExposureController run after every readout
+
+    def log_exposure(self):
+        """ Keep track of exposure changes, call after the exposure is set """
+        self.exposure_log.append((self.current_count(), self.get_exposure()))
+
+    def current_count(self):
+        """ Number of the latest trigger, counted the same way as readout_count """
+        if self.count_source:
+            return(self.count_source(time.time()) or 0)
+        return(self.triggercount)
+
+    def exposure_at_trigger(self):
+        """ Exposure the current readout was taken at """
+        exposure = None
+        for count, logged in self.exposure_log:
+            if count >= self.readout_count:
+                break
+            exposure = logged
+        if exposure is None:
+            return(self.get_exposure())
+        return(exposure)
+
+    def saturation_level(self):
+        """ Robust maximum of the current readout """
+        return(robust_max(self.data))
+
+    def get_exposure(self):
+        return(float(pv_cache.get(self.exposure_pv)))
+
+    def auto_exposure_step(self):
+        """
+        Update exposure from the current readout. Returns True when the
+        readout is well exposed, or exposure is at its limit.
+        """
+        level = self.saturation_level()
+        exposure = self.get_exposure()
+        if numpy.isnan(level):
+            print(self.dev_type + ' readout is empty, can not set exposure')
+            return(False)
+        if exposure_converged(level, self.saturation, self.exposure_target, self.exposure_tolerance):
+            print(self.dev_type + ' exposure ' + str(exposure) + ' is good, level ' + str(level))
+            return(True)
+        new = estimate_exposure(exposure, level, self.saturation, self.exposure_target,
+                                self.exposure_min, self.exposure_max)
+        if numpy.isclose(new, exposure):
+            print(self.dev_type + ' exposure is at its limit, ' + str(exposure))
+            return(True)
+        self.set_exposure(new)
+        return(False)
+
+    def exposure_settings(self):
+        """ Settings that auto exposure converged to, for ExposureCache """
+        return({'exposure': self.get_exposure()})
+
+    def restore_exposure_settings(self, settings):
+        self.set_exposure(settings['exposure'])
+
+    def wait_until_ready(self, timeout=10):
+        """ Wait for the device to get data, woken up by notify_ready """
+        if self.ready_condition is None:
+            self.ready_condition = threading.Condition()
+        deadline = time.time() + timeout
+        with self.ready_condition:
+            while(not self.is_ready_p()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError(self.dev_type + ' timed out while waiting for data!')
+                self.ready_condition.wait(min(0.1, remaining))
+
+    def auto_exposure(self, trigger_fun, max_triggers=10):
+        """Do auto exposure. Trigger fun should give a single trigger working with
+        the configured device. Returns the number of triggers used."""
+        if self.saturation is None:
+            return(0)
+        self.connect()
+        try:
+            for n in range(1, max_triggers + 1):
+                self.clear()
+                trigger_fun()
+                self.wait_until_ready()
+                if self.auto_exposure_step():
+                    break
+        finally:
+            self.clear()
+            self.disconnect()
+        print(self.dev_type + ' auto exposure done in ' + str(n) + ' triggers.')
+        return(n)
+
     def set_ready(self, pvn, value, timestamp):
         """
         Mark device as ready for read out, copy data to object.
@@ -360,14 +2197,36 @@ class Cool_device(object):
         """
         self.triggercount += 1
         # print('Getting data to callback! ' + self.dev_type)
-        if(not self.is_ready):
-            # print('Got data from ' + self.dev_type + ', aka: ' + str(pvn))
-            self.data = value
-            self.timestamp = timestamp
-        else:
-            print(self.dev_type + ": New trigger before readout finished! Potentially desynced event!")
-            self.potentially_desynced = True
-        self.is_ready = True
+        data, token = self.buffers.store(self.frame_view(value))
+        with self._readout_lock:
+            if(not self.is_ready):
+                # print('Got data from ' + self.dev_type + ', aka: ' + str(pvn))
+                self.data = data
+                self.timestamp = timestamp
+                self.readout_count = self.triggercount
+                self._slot = token
+            elif len(self._pending) < self.max_pending:
+                print(self.dev_type + ": New trigger before readout finished! Kept for next readout.")
+                self._pending.append((data, timestamp, self.triggercount, token))
+                # Without the event builder nothing checks it belongs to the next event
+                if not self.matched_queue:
+                    self.potentially_desynced = True
+            else:
+                print(self.dev_type + ": New trigger before readout finished! Potentially desynced event!")
+                self.buffers.release(token)
+                self.potentially_desynced = True
+            self.is_ready = True
+        self.notify_ready()
+
+    def frame_view(self, value):
+        """ Shape the callback value for saving. Overload to reinterpret data """
+        return(value)
+
+    def notify_ready(self):
+        """ Wake up a Coolector waiting for data """
+        if self.ready_condition:
+            with self.ready_condition:
+                self.ready_condition.notify_all()
 
     def sw_trigger(self):
         """ Pass a SW trigger to the device """
@@ -384,19 +2243,66 @@ class Cool_device(object):
         return(self.is_ready)
 
     def clear(self):
-        """ Clear data from device. For EPICS devices, sinply set is_ready to false. """
+        """ Clear data from device, including triggers waiting for readout. """
         print('clearing ' + str(self.dev_type))
-        self.is_ready = False
-        self.potentially_desynced = False
+        with self._readout_lock:
+            self.buffers.release(self._slot)
+            self._slot = None
+            while self._pending:
+                self.buffers.release(self._pending.popleft()[3])
+            self.is_ready = False
+            self.potentially_desynced = False
+
+    def advance(self):
+        """
+        The current readout is done, move on to the next trigger that arrived
+        before readout, if there is one.
+        """
+        with self._readout_lock:
+            self.buffers.release(self._slot)
+            self._slot = None
+            self.potentially_desynced = False
+            if self._pending:
+                self.data, self.timestamp, self.readout_count, self._slot = self._pending.popleft()
+                self.is_ready = True
+            else:
+                self.is_ready = False
+
+    def hand_off(self):
+        """
+        Hand the buffer of the current readout to an event. Returns a
+        function that gives it back once the event is written.
+        """
+        with self._readout_lock:
+            token = self._slot
+            self._slot = None
+        if token is None:
+            return(None)
+        return(lambda: self.buffers.release(token))
+
+    def snapshot(self):
+        """
+        Evaluate all attributes and datasets for the current readout.
+
+        Overload if stuff needs to happen before the values are read
+        """
+        release = self.hand_off()
+        try:
+            snap = self.savedata.snapshot()
+        except Exception:
+            if release:
+                release()
+            raise
+        snap['release'] = release
+        self.completion_wait = 0.0
+        return(snap)
 
     def write(self, h5f):
         """
         Write all pvs in meta_pvnames to attributes in group.
         Call write_datasets function.
-
-        Overload if stuff needs to happen before write
         """
-        self.savedata.write(h5f)
+        write_snapshot(h5f, self.snapshot())
 
     def pv_to_attribute(self, prefix, *pvs):
         """
@@ -404,7 +2310,7 @@ class Cool_device(object):
         """
         for pv in pvs:
             print(prefix + pv)
-            self.savedata.attrs[prefix + pv] = lambda: epics.caget(prefix + pv)
+            self.savedata.attrs[prefix + pv] = monitored(prefix + pv)
         for pv in pvs:
             print(self.savedata.attrs[prefix + pv]())
 
@@ -414,6 +2320,10 @@ class Manta_cam(Cool_device):
     Manta camera
     """
     dev_type = 'Manta camera'
+    saturation = 2**12 - 1
+    stats_pv = None  # Stats plugin MaxValue, see enable_stats_plugin
+    # 12 bit pixels in 16 bit words: bit shuffle removes the empty bits, LZ4 keeps up with the frame rate
+    compression = 'blosc-lz4-bitshuffle'
 
     def sw_trigger(self):
         """ Set Acquire to True """
@@ -426,22 +2336,57 @@ class Manta_cam(Cool_device):
         exposure = max(exposure, self.exposure_min)
         exposure = min(exposure, self.exposure_max)
         print('Setting exposure to: ' + str(exposure))
-        epics.caput(self.port + ':det1:AcquireTime', exposure)
-        time.sleep(0.1)
+        self.wait_for_put(self.port + ':det1:AcquireTime', exposure,
+                          readback=self.port + ':det1:AcquireTime_RBV')
+        self.log_exposure()
+        self.savedata.invalidate_static()
 
     def set_gain(self, gain):
         """
         Set gain.
         """
         print('Setting gain to: ' + str(gain))
-        epics.caput(self.port + ':det1:Gain', gain)
-        time.sleep(0.1)
+        self.wait_for_put(self.port + ':det1:Gain', gain,
+                          readback=self.port + ':det1:Gain_RBV')
+        self.savedata.invalidate_static()
+
+    def exposure_settings(self):
+        settings = super().exposure_settings()
+        settings['gain'] = float(pv_cache.get(self.port + ':det1:Gain_RBV'))
+        return(settings)
+
+    def restore_exposure_settings(self, settings):
+        super().restore_exposure_settings(settings)
+        if 'gain' in settings:
+            self.set_gain(settings['gain'])
+
+    def frame_shape(self):
+        """ Frame geometry from the monitored size readbacks, (Y, X) """
+        return((int(pv_cache.get(self.port + ':det1:SizeY_RBV')),
+                int(pv_cache.get(self.port + ':det1:SizeX_RBV'))))
+
+    def frame_view(self, value):
+        """
+        The callback array as a (Y, X) uint16 frame. 16 bit data from
+        Channel Access arrives as int16, and is reinterpreted without a copy.
+        """
+        value = numpy.asarray(value)
+        if value.dtype.itemsize == 2:
+            value = value.view(numpy.uint16)
+        else:
+            value = value.astype(numpy.uint16)
+        shape = self.frame_shape()
+        if value.size < shape[0] * shape[1]:
+            print('Frame is smaller than ' + str(shape) + ', geometry changed?')
+            return(value)
+        return(value[:shape[0] * shape[1]].reshape(shape))
 
     def get_reshaped_data(self):
-        print('Hello!')
-        print(self.data)
-        return(self.data.reshape(epics.caget(self.port + ':det1:SizeY_RBV'),
-                                 epics.caget(self.port + ':det1:SizeX_RBV')))
+        return(self.data)
+
+    def connect(self):
+        self.buffers.allocate(self.frame_shape(), numpy.uint16)
+        return(super().connect())
 
     def __init__(self, port, lens_id, focal_length, f_number,
                  sw_trig=False,
@@ -459,26 +2404,31 @@ class Manta_cam(Cool_device):
                          port + ':image1:ArrayData')
         self.exposure_min = exposure_min
         self.exposure_max = exposure_max
+        self.exposure_pv = port + ':det1:AcquireTime_RBV'
+        self.savedata.attrs['exposure_at_trigger'] = lambda: self.exposure_at_trigger()
         self.lens_controller = False
 
         # Initialize device
-        for pvname, value in {':image1:EnableCallbacks': 1,  # Enable
-                              ':image1:ArrayCallbacks': 1,  # Enable
-                              ':det1:DataType': 1,  # UInt16, 12-bit
-                              ':det1:LEFTSHIFT': 0}.items():  # Disable
-            epics.caput(port + pvname, value)
-
+        settings = [(port + ':image1:EnableCallbacks', 1),  # Enable
+                    (port + ':image1:ArrayCallbacks', 1),  # Enable
+                    (port + ':det1:DataType', 1, port + ':det1:DataType_RBV'),  # UInt16, 12-bit
+                    (port + ':det1:LEFTSHIFT', 0, port + ':det1:LEFTSHIFT_RBV')]  # Disable
         # Initialization for SW triggers
-        if(sw_trig):
-            epics.caput(port + ':det1:ImageMode', 0)  # Get a single image
-        # Initialization for HW triggers
-        else:
-            epics.caput(port + ':det1:Acquire', 0)
-            epics.caput(port + ':det1:ImageMode', 2)  # Get images continously
-            epics.caput(port + ':det1:TriggerMode', 1)  # Enable trigger mode
-            epics.caput(port + ':det1:TriggerSelector', 0)  # Enable trigger mode
-            epics.caput(port + ':det1:TriggerSource', 1)  # Enable trigger mode
-            epics.caput(port + ':det1:Acquire', 1)
+        self.presets['sw_trigger'] = Preset(
+            [settings + [(port + ':det1:ImageMode', 0)]])  # Get a single image
+        # Initialization for HW triggers, acquisition is restarted if anything changes
+        self.presets['hw_trigger'] = Preset(
+            [[(port + ':det1:TriggerSelector', 0)],  # Selector before the trigger settings
+             settings + [(port + ':det1:ImageMode', 2),  # Get images continously
+                         (port + ':det1:TriggerMode', 1),  # Enable trigger mode
+                         (port + ':det1:TriggerSource', 1)],  # Enable trigger mode
+             [(port + ':det1:Acquire', 1)]],
+            before=[(port + ':det1:Acquire', 0)])
+        readbacks = [':det1:SizeX_RBV', ':det1:SizeY_RBV', ':det1:Manufacturer_RBV',
+                     ':det1:Model_RBV', ':det1:AcquireTime_RBV', ':det1:Gain_RBV',
+                     ':det1:NumImagesCounter_RBV']
+        self.configure('sw_trigger' if sw_trig else 'hw_trigger',
+                       [port + pvname for pvname in readbacks])
 
         # Set exposure and gain from init arguments
         if(exposure):
@@ -489,20 +2439,20 @@ class Manta_cam(Cool_device):
         # Setting up data saving
         # Metadata that will be dumped to device
         sda = self.savedata.attrs
-        sda['acquire_duration'] = lambda: epics.caget(port + ':det1:AcquireTime_RBV')
+        sda['acquire_duration'] = monitored(port + ':det1:AcquireTime_RBV')
         sda['lens_id'] = lens_id
         sda['f_number'] = f_number
         sda['focal_length'] = focal_length
         sda['photons_per_count'] = photons_per_count
-        sda[port + ':det1:SizeX_RBV'] = lambda: epics.caget(port + ':det1:SizeX_RBV')
-        sda[port + ':det1:SizeY_RBV'] = lambda: epics.caget(port + ':det1:SizeY_RBV')
-        sda[port + ':det1:Manufacturer_RBV'] = lambda: epics.caget(port + ':det1:Manufacturer_RBV')
-        sda[port + ':det1:Model_RBV'] = lambda: epics.caget(port + ':det1:Model_RBV')
-        sda[port + ':det1:AcquireTime_RBV'] = lambda: epics.caget(port + ':det1:AcquireTime_RBV')
-        sda[port + ':det1:Gain_RBV'] = lambda: epics.caget(port + ':det1:Gain_RBV')
-        sda[port + ':det1:LEFTSHIFT_RBV'] = lambda: epics.caget(port + ':det1:LEFTSHIFT_RBV')
-        sda[port + ':det1:NumImagesCounter_RBV'] = lambda: epics.caget(port + ':det1:NumImagesCounter_RBV')
-        sda[port + ':det1:DataType_RBV'] = lambda: epics.caget(port + ':det1:DataType_RBV')
+        sda[port + ':det1:SizeX_RBV'] = monitored(port + ':det1:SizeX_RBV')
+        sda[port + ':det1:SizeY_RBV'] = monitored(port + ':det1:SizeY_RBV')
+        sda[port + ':det1:Manufacturer_RBV'] = Static(monitored(port + ':det1:Manufacturer_RBV'))
+        sda[port + ':det1:Model_RBV'] = Static(monitored(port + ':det1:Model_RBV'))
+        sda[port + ':det1:AcquireTime_RBV'] = monitored(port + ':det1:AcquireTime_RBV')
+        sda[port + ':det1:Gain_RBV'] = monitored(port + ':det1:Gain_RBV')
+        sda[port + ':det1:LEFTSHIFT_RBV'] = Static(monitored(port + ':det1:LEFTSHIFT_RBV'))
+        sda[port + ':det1:NumImagesCounter_RBV'] = monitored(port + ':det1:NumImagesCounter_RBV')
+        sda[port + ':det1:DataType_RBV'] = Static(monitored(port + ':det1:DataType_RBV'))
         
         ds = Dataset('data', lambda: self.get_reshaped_data())
         ds.attrs['pvname'] = self._callback_pvname
@@ -512,70 +2462,42 @@ class Manta_cam(Cool_device):
         ds.attrs['y-units'] = 'Pixels'
         self.savedata.add_dataset(ds)
 
+    def enable_stats_plugin(self, plugin='stats1'):
+        """
+        Take the saturation level from the areaDetector Stats plugin instead
+        of the frame. Note that MaxValue includes hot pixels.
+        """
+        put_stages([[(self.port + ':' + plugin + ':EnableCallbacks', 1),
+                     (self.port + ':' + plugin + ':ComputeStatistics', 1)]])
+        self.stats_pv = self.port + ':' + plugin + ':MaxValue_RBV'
+        pv_cache.pv(self.stats_pv)
+
+    def saturation_level(self):
+        """ Robust maximum of the frame, the brightest 3x3 block of every 2nd pixel """
+        if self.stats_pv:
+            return(float(pv_cache.get(self.stats_pv)))
+        return(robust_max(self.data, step=2))
+
     def enable_lens_controller(self, focus=None, aper=None):
         # self.efc = EF_Controller()
         self.lens_controller=True
         epics.caput("LENS:ping", 1)
         time.sleep(1)
         sda = self.savedata.attrs
+        # The lens info is only updated after a ping, keep pinging in the background
+        self.sample_slowly('lens_ping', 'LENS:ping', lambda: put_and_wait('LENS:ping', 1))
+        if self.connections > 0:
+            slow_control.start()
         sda['lens_controller'] = 'ISSI_EPICS'
-        sda['lens_id'] = lambda: epics.caget("LENS:lens")
-        sda['f_number'] = lambda: float(epics.caget("LENS:getAper"))
-        sda['focus'] = lambda: float(epics.caget("LENS:getFocus"))
-        sda['focal_length'] = lambda: float(epics.caget("LENS:getFocalLength"))
+        sda['lens_id'] = monitored("LENS:lens")
+        sda['f_number'] = lambda: float(pv_cache.get("LENS:getAper"))
+        sda['focus'] = lambda: float(pv_cache.get("LENS:getFocus"))
+        sda['focal_length'] = lambda: float(pv_cache.get("LENS:getFocalLength"))
         if(focus):
             self.efc.set_focus(focus)
         if(aper):
             self.efc.set_aperture(aper)
     
-    def write(self, h5g):
-        """
-        If lens controller is enabled, it must be pinged before we can read back lens info
-        """
-        if(self.lens_controller): epics.caput('LENS:ping', 1)
-        time.sleep(0.1)
-        super().write(h5g)
-
-    def auto_exposure(self, trigger_fun):
-        """ Auto exposure:
-        - Set camera to single exposure modde
-        - Find the correct exposure
-        - Set camera back to initial configuration
-        """
-        print('Camera auto exposure!')
-        exposure_level = 0.5
-        self.connect()
-        trigger_fun()
-        time.sleep(0.1)
-        self.set_exposure(0.15)
-        while(True):
-            self.clear()
-            trigger_fun()
-            while(not self.is_ready_p()):
-                time.sleep(0.1)
-            exp = epics.caget(self.port + ':det1:AcquireTime_RBV')
-            data = epics.caget(self.port + ':image1:ArrayData')
-            data = data.reshape(epics.caget(self.port + ':det1:SizeY_RBV'),
-                                epics.caget(self.port + ':det1:SizeX_RBV'))
-            sm = scipy.ndimage.filters.median_filter(data, 9).max()
-            print('Over exposed is ' + str(sm))
-            print('Max smoothed is ' + str(sm))
-            max_image = 2**12 - 1
-            exp = epics.caget(self.port + ':det1:AcquireTime_RBV')
-            autoset = exp * (max_image * exposure_level)/sm
-            self.set_exposure(autoset)
-            if(autoset > self.exposure_max):
-                print('Exposure set to max!')
-                break
-            if(autoset < self.exposure_min):
-                print('Exposure set to min!')
-                break
-            if(autoset/exp > (1/1.5) and autoset/exp < 1.5):
-                print('Exposure set to ' + str(autoset))
-                break
-        print('Auto exposure done.')
-        self.disconnect()
-        return()
 
 
 class Thorlabs_spectrometer(Cool_device):
@@ -583,6 +2505,10 @@ class Thorlabs_spectrometer(Cool_device):
     Thorlabs CCS100 spectrometer
     """
     dev_type = 'Thorlabs spectrometer'
+    saturation = 2**16 - 1
+    exposure_target = 0.6
+    _wavelength_count = None
+    compression = 'blosc-lz4-byteshuffle'  # Floating point spectra
 
     def sw_trigger(self): epics.caput(self.port + ':det1:Acquire', 1)
 
@@ -593,8 +2519,10 @@ class Thorlabs_spectrometer(Cool_device):
         exposure = max(exposure, self.exposure_min)
         exposure = min(exposure, self.exposure_max)
         print('Setting exposure to: ' + str(exposure))
-        epics.caput(self.port + ':det1:AcquireTime', exposure)
-        time.sleep(0.1)
+        self.wait_for_put(self.port + ':det1:AcquireTime', exposure,
+                          readback=self.port + ':det1:AcquireTime_RBV')
+        self.log_exposure()
+        self.savedata.invalidate_static()
 
     def __init__(self, port,
                  sw_trig=False,
@@ -611,42 +2539,48 @@ class Thorlabs_spectrometer(Cool_device):
     
         self.exposure_min = exposure_min
         self.exposure_max = exposure_max
+        self.exposure_pv = port + ':det1:AcquireTime_RBV'
+        self.savedata.attrs['exposure_at_trigger'] = lambda: self.exposure_at_trigger()
 
         # Initialize device
-        for pvname, value in {':det1:TlAcquisitionType': 0,  # 1 is processed, set to 0 for raw
-                              ':trace1:EnableCallbacks': 1,  # Enable
-                              ':trace1:ArrayCallbacks': 1,  # Enable
-                              ':det1:TlAmplitudeDataTarget': 2,  # Thorlabs
-                              ':det1:TlWavelengthDataTarget': 0}.items():  # Factory
-            epics.caput(port + pvname, value)
-        if(sw_trig):
-            for pvname, value in {':det1:ImageMode': 0,  # Single
-                                  ':det1:TriggerMode': 0}.items():  # Internal
-                epics.caput(port + pvname, value)
-        else:
-            for pvname, value in {':det1:Acquire': 0,
-                                  ':det1:ImageMode': 1,  # Continuous
-                                  ':det1:TriggerMode': 1}.items():  # External
-                epics.caput(port + pvname, value)
-            epics.caput(port + ':det1:Acquire', 1)
-
-        epics.caput(port + ':det1:TlAmplitudeDataGet', 1)  # Get amplitudes
-        epics.caput(port + ':det1:TlWavelengthDataGet', 1)  # Get waves
+        settings = [(port + ':det1:TlAcquisitionType', 0),  # 1 is processed, set to 0 for raw
+                    (port + ':trace1:EnableCallbacks', 1),  # Enable
+                    (port + ':trace1:ArrayCallbacks', 1),  # Enable
+                    (port + ':det1:TlAmplitudeDataTarget', 2),  # Thorlabs
+                    (port + ':det1:TlWavelengthDataTarget', 0)]  # Factory
+        # Fetch commands, not settings: always run, and again after the data targets changed
+        get_data = [(port + ':det1:TlAmplitudeDataGet', 1),  # Get amplitudes
+                    (port + ':det1:TlWavelengthDataGet', 1)]  # Get waves
+        self.presets['sw_trigger'] = Preset(
+            [settings + [(port + ':det1:ImageMode', 0),  # Single
+                         (port + ':det1:TriggerMode', 0)]],  # Internal
+            after=get_data, prepare=get_data)
+        self.presets['hw_trigger'] = Preset(
+            [settings + [(port + ':det1:ImageMode', 1),  # Continuous
+                         (port + ':det1:TriggerMode', 1)],  # External
+             [(port + ':det1:Acquire', 1)]],
+            before=[(port + ':det1:Acquire', 0)],
+            after=get_data, prepare=get_data)
+        readbacks = [':det1:AcquireTime_RBV', ':det1:NumImagesCounter_RBV', ':det1:Model_RBV',
+                     ':det1:Manufacturer_RBV', ':det1:TlWavelengthData_RBV',
+                     ':det1:TlAmplitudeData_RBV']
+        self.configure('sw_trigger' if sw_trig else 'hw_trigger',
+                       [port + pvname for pvname in readbacks])
 
         # Set exposure from argument
         if(exposure):
             self.set_exposure(exposure)
 
         sda = self.savedata.attrs
-        sda['acquire_duration'] = lambda: epics.caget(port + ':det1:AcquireTime_RBV')
+        sda['acquire_duration'] = monitored(port + ':det1:AcquireTime_RBV')
         # sda[port + ':det1:AcquireTime_RBV'] = lambda: epics.caget(port + ':det1:AcquireTime_RBV')
-        sda[port + ':det1:NumImagesCounter_RBV'] = lambda: epics.caget(port + ':det1:NumImagesCounter_RBV')
-        sda[port + ':det1:Model_RBV'] = epics.caget(self.port + ':det1:Model_RBV')
-        sda[port + ':det1:Manufacturer_RBV'] = epics.caget(port + ':det1:Manufacturer_RBV')
+        sda[port + ':det1:NumImagesCounter_RBV'] = monitored(port + ':det1:NumImagesCounter_RBV')
+        sda[port + ':det1:Model_RBV'] = Static(monitored(port + ':det1:Model_RBV'))
+        sda[port + ':det1:Manufacturer_RBV'] = Static(monitored(port + ':det1:Manufacturer_RBV'))
 
         # Data sets
         pv1 = port + ':det1:TlWavelengthData_RBV'
-        x_data = Dataset('x_values', lambda: epics.caget(pv1))
+        x_data = Dataset('x_values', monitored(pv1))
         x_data.attrs['pvname'] = pv1
         x_data.attrs['label'] = 'Wavelength'
         x_data.attrs['unit'] = 'nm'
@@ -660,50 +2594,22 @@ class Thorlabs_spectrometer(Cool_device):
         self.savedata.add_dataset(y_data)
 
         pv3 = port + ':det1:TlAmplitudeData_RBV'
-        scale_data = Dataset('y_scale', lambda: epics.caget(pv3))
+        scale_data = Dataset('y_scale', monitored(pv3))
         scale_data.attrs['pvname'] = pv3
         scale_data.attrs['label'] = 'Correction'
         scale_data.attrs['unit'] = 'Scale factor'
         self.savedata.add_dataset(scale_data)
 
-    def auto_exposure(self, trigger_fun):
-        """ Auto exposure:
-        
-        """
-        print('CCS exposure!')
-        exposure_level = 0.6
-        self.connect()
-        trigger_fun()
-        time.sleep(0.1)
-        while(True):
-            self.clear()
-            trigger_fun()
-            while(not self.is_ready_p()):
-                time.sleep(0.1)
-            exp = epics.caget(self.port + ':det1:AcquireTime_RBV')
-            wave = epics.caget(self.port + ':det1:TlWavelengthData_RBV')
-            data = epics.caget(self.port + ':trace1:ArrayData')[0:len(wave)]
-            sm = scipy.signal.medfilt(data, 3).max()
-            max_array = 2**16 - 1
-            exp = epics.caget(self.port + ':det1:AcquireTime_RBV')
-            autoset = exp * (max_array * exposure_level)/sm
-            self.set_exposure(autoset)
-            if(autoset > self.exposure_max):
-                print('Exposure set to max!')
-                break
-            if(autoset < self.exposure_min):
-                print('Exposure set to min!')
-                break
-            if(autoset/exp > (1/1.5) and autoset/exp < 1.5):
-                print('Exposure set to ' + str(autoset))
-                break
-        print('Auto exposure done.')
-        self.disconnect()
-        return()
-        # print('CSS auto exposure')
-        # cam_exp = epics.caget('CAM1:det1:AcquireTime_RBV')
-        # print('Set exposure to ' + str(cam_exp * 5))
-        # self.set_exposure(cam_exp * 5)
+    def wavelength_count(self):
+        """ Length of the wavelength array, the spectrum PV is longer. 0 until it is fetched """
+        if not self._wavelength_count:
+            waves = pv_cache.get(self.port + ':det1:TlWavelengthData_RBV')
+            self._wavelength_count = 0 if waves is None else numpy.size(waves)
+        return(self._wavelength_count)
+
+    def saturation_level(self):
+        """ Maximum of the spectrum after a 3 point median """
+        return(robust_max(self.data[0:self.wavelength_count()]))
 
 
 class PicoscopePython(Cool_device):
@@ -712,6 +2618,11 @@ class PicoscopePython(Cool_device):
     """
     dev_type = 'PicoScope 4264, python'
     data = None
+    compression = 'blosc-lz4-bitshuffle'  # Long 16 bit waveforms
+    min_trigger_interval = 0.05  # Seconds, should not ask for triggers to fast
+    trigger_rank = 1  # edgesCaught counts every trigger, used when there is no Raspi_trigger
+    exposure_margin = 1.25  # Capture window relative to the longest exposure
+    _last_trigger = 0.0
 
     def get_glob_trigger(self):
         # Get trigger number for last caught trigger
@@ -720,16 +2631,29 @@ class PicoscopePython(Cool_device):
         else:
             return(False)
 
+    def trigger_number(self):
+        return(self._ps.edgesCaught)
+
+    def on_capture(self):
+        """ A capture was queued by the ps4262 thread, keep its trigger time """
+        self.trigger_times.append(self._ps.data[-1]['timestamp'], self._ps.edgesCaught + self.count_offset)
+        self.notify_ready()
+
     def set_exposure(self, exposure):
         self._ps.setTimeBase(requestedSamplingInterval=self.samplingInterval,
                              tCapture=exposure)
+        self.metadata.invalidate()
 
     def __init__(self, voltage_range=1, sampling_interval=2e-7,
                  capture_duration=0.66, trig_per_min=30, send_triggers=False):
         super().__init__('ps4264', 'data/oscope/ps4264py/', self.dev_type, None)
+        self.matchable = True
         self.samplingInterval = sampling_interval
         self._ps = ps4262(VRange=voltage_range, requestedSamplingInterval=sampling_interval,
                           tCapture=capture_duration, triggersPerMinute=trig_per_min)
+        # ps4262 appends captures to this queue from its own thread
+        self._ps.data = NotifyingDeque(self._ps.data, notify=self.on_capture)
+        self.trigger_times = RingBuffer(1024)
         # Configuring data for saving
         current = Dataset('y_data', lambda: self.data['raw_data'])
         # current.attrs['label'] = 'raw_data'
@@ -741,15 +2665,17 @@ class PicoscopePython(Cool_device):
         self.potentially_desynced = len(self._ps.data) > 0
         self.savedata.attrs['Queue length'] = lambda: len(self._ps.data)
         self.savedata.attrs['acquire_duration'] = lambda: self.acquire_duration
-        self.metadata = None
+        # Scope settings, only change with the settings below
+        self.metadata = Static(lambda: self._ps.getMetadata())
         self.send_triggers = send_triggers
 
-    def write(self, h5f):
+    def snapshot(self):
         for key, value in self.data.items():
             if key != 'raw_data':
                 self.currentds.attrs[key] = value
-        super().write(h5f)
-        self.savedata.write_additional_meta(h5f, self.metadata)
+        snap = super().snapshot()
+        snap['static'].update(self.metadata.value())
+        return(snap)
 
     def is_ready_p(self):
         """If we do not have fresh data, wait for it. If we do, we are ready."""
@@ -759,60 +2685,86 @@ class PicoscopePython(Cool_device):
         if(len(self._ps.data) > 0):
             print('Pico data!!')
             self.data = self._ps.data.popleft()
+            if not self.matched_queue:
+                self.potentially_desynced = len(self._ps.data) > 0
             self.timestamp = self.data['timestamp']
             self.triggercount = self._ps.edgesCaught
+            # Captures still queued came after this one
+            self.readout_count = self.triggercount - len(self._ps.data) + self.count_offset
             self.acquire_duration = self.data['t_end'] - self.data['t0']
             self.is_ready = True
-            self.metadata = self._ps.getMetadata()
         return(self.is_ready)
 
     def clear(self):
         """Should set _ps.data to None"""
         self.is_ready = False
+        self.potentially_desynced = False
         self._ps.data.clear()
 
+    def advance(self):
+        """ Captures that arrived before readout stay queued for the next readout """
+        self.is_ready = False
+        self.potentially_desynced = False
+
     def sampling(self, sampling_interval, duration):
         """ How long, and at what frequency, will the recorded waveforms be? """
         self._ps.setTimeBase(requestedSamplingInterval=sampling_interval,
                              tCapture=duration)
+        self.metadata.invalidate()
 
     def triggers_per_minute(self, tpm):
         """ Set tmp to 0 for single pulse generation """
         self._ps.setFGrn(triggersPerMinute=tpm)
+        self.metadata.invalidate()
 
     def hw_trigger(self):
         if(self.send_triggers):
             print('PS will trigger!')
+            # Only wait if the previous trigger was too recent
+            waited = max(0, self._last_trigger + self.min_trigger_interval - time.time())
+            if waited:
+                time.sleep(waited)
+            self.completion_wait += waited
             self._ps.setFGen(triggersPerMinute=-1)
-            time.sleep(.05)  # Should not ask for triggers to fast
+            self._last_trigger = time.time()
             return(True)
 
-    def check_exposure(self):
+    def check_exposure(self, exposures=None):
         """
         See if exposure settings are ok
         """
         print("Checking picoscope exposure settings")
-        cam_exp = epics.caget('CAM1:det1:AcquireTime_RBV')
-        css_exp = epics.caget('CCS1:det1:AcquireTime_RBV')
+        if exposures is None:
+            exposures = self.default_exposures()
         ps_exp = self._ps.tCapture
-        if (ps_exp < 1.25 * max(cam_exp, css_exp)):
+        if (ps_exp < self.exposure_margin * max(exposures)):
             print('Picoscope exposure is shorter than camera or spectrometer exposure')
             input('Press Enter to continue')
 
+    def default_exposures(self):
+        """ Exposures of CAM1 and CCS1, for use without a Coolector """
+        return([epics.caget('CAM1:det1:AcquireTime_RBV'),
+                epics.caget('CCS1:det1:AcquireTime_RBV')])
+
+    def follow_exposure(self, exposures):
+        """ Capture window covering the longest exposure """
+        if not exposures:
+            return
+        print('Set exposure to ' + str(self.exposure_margin * max(exposures)))
+        self.set_exposure(self.exposure_margin * max(exposures))
+
     def auto_exposure(self, trigger_fun):
         """ Auto exposure:
         Set to max of camera exposure, spectrometer exposure
         """
         print('Picoscope exposure')
-        cam_exp = epics.caget('CAM1:det1:AcquireTime_RBV')
-        css_exp = epics.caget('CCS1:det1:AcquireTime_RBV')
-        print('Set exposure to ' + str(1.25 * max(cam_exp, css_exp)))
-        self.set_exposure(1.25 * max(cam_exp, css_exp))
+        self.follow_exposure(self.default_exposures())
 
 
 class LinearStage(Cool_device):
     """ Code for setting up, reading position and moving the linear stage """
     dev_type = 'Standa linear stage'
+    _stage_lock = threading.Lock()  # One controller, used by the position poller and by moves
 
     def __init__(self):
         super().__init__('standa',
@@ -824,19 +2776,26 @@ class LinearStage(Cool_device):
         self.sample_dict = collections.OrderedDict()
         self.sample_name = ''
         # Save data
-        self.savedata.attrs['Samples'] = lambda: [x.encode('utf8') for x in list(self.sample_dict.keys())]
-        self.savedata.attrs['Positions'] = lambda: list(self.sample_dict.values())
-        self.savedata.attrs['current_position'] = lambda: moveStage.get_position()
+        self.savedata.attrs['Samples'] = Static(lambda: [x.encode('utf8') for x in list(self.sample_dict.keys())])
+        self.savedata.attrs['Positions'] = Static(lambda: list(self.sample_dict.values()))
+        self.sample_slowly('current_position', 'standa:position', self.read_position)
         self.savedata.attrs['current_sample'] = lambda: self.sample_name
 
     def add_sample(self, name, position):
         self.sample_dict[name] = position
+        self.savedata.invalidate_static()
+
+    def read_position(self):
+        with self._stage_lock:
+            return(moveStage.get_position())
 
     def move_to_sample(self, sample):
         self.pos = self.sample_dict[sample]
         self.sample_name = sample
-        moveStage.move_to(self.pos)
-        time.sleep(0.1)
+        with self._stage_lock:
+            moveStage.move_to(self.pos)
+            time.sleep(0.1)
+        slow_control.sample('standa:position')
         return(True)
 
     def is_ready_p(self):
@@ -851,29 +2810,34 @@ class SuperCool(Cool_device):
         super().__init__('LT59', 'data/temperature/LT59/', self.dev_type, None)
         self.triggercount = 0
 
-        # Initialize device
-        epics.caput('LT59:Retrieve', 1)
-        epics.caput('LT59:Temp1Mode', 1)
-        epics.caput('LT59:Temp1CoeffA', 3.9083E-3)
-        epics.caput('LT59:Temp1CoeffB', -5.7750E-7)
-        epics.caput('LT59:Temp1CoeffC', 1000)
-        epics.caput('LT59:Mode', 6)
-        epics.caput('LT59:Send', 1)
+        # Initialize device, settings are read back with Retrieve and committed with Send
+        self.presets['default'] = Preset(
+            [[('LT59:Temp1Mode', 1),
+              ('LT59:Temp1CoeffA', 3.9083E-3, 'LT59:Temp1CoeffA_RBV'),
+              ('LT59:Temp1CoeffB', -5.7750E-7, 'LT59:Temp1CoeffB_RBV'),
+              ('LT59:Temp1CoeffC', 1000, 'LT59:Temp1CoeffC_RBV'),
+              ('LT59:Mode', 6, 'LT59:Mode_RBV')]],
+            after=[('LT59:Send', 1)],
+            prepare=[('LT59:Retrieve', 1)])
+        self.configure('default', ['LT59:Temp1_RBV', 'LT59:StartStop_RBV'])
 
         # Set up data saving
         sda = self.savedata.attrs
-        sda['LT59:Temp1Mode'] = lambda: epics.caget('LT59:Temp1Mode')
-        sda['LT59:Temp1CoeffA_RBV'] = lambda: epics.caget('LT59:Temp1Mode')
-        sda['LT59:Temp1CoeffB_RBV'] = lambda: epics.caget('LT59:Temp1CoeffB_RBV')
-        sda['LT59:Temp1CoeffC_RBV'] = lambda: epics.caget('LT59:Temp1CoeffC_RBV')
-        sda['LT59:Mode_RBV'] = lambda: epics.caget('LT59:Mode_RBV')
-        sda['LT59:Temp1_RBV'] = lambda: epics.caget('LT59:Temp1_RBV')
-        sda['LT59:StartStop_RBV'] = lambda: epics.caget('LT59:StartStop_RBV')
-
-    def write(self, h5g):
-        epics.caput('LT59:Retrieve', 1)
-        time.sleep(0.1)
-        super().write(h5g)
+        sda['LT59:Temp1Mode'] = monitored('LT59:Temp1Mode')
+        sda['LT59:Temp1CoeffA_RBV'] = monitored('LT59:Temp1CoeffA_RBV')
+        sda['LT59:Temp1CoeffB_RBV'] = monitored('LT59:Temp1CoeffB_RBV')
+        sda['LT59:Temp1CoeffC_RBV'] = monitored('LT59:Temp1CoeffC_RBV')
+        sda['LT59:Mode_RBV'] = monitored('LT59:Mode_RBV')
+        sda['LT59:Temp1_RBV'] = monitored('LT59:Temp1_RBV')
+        sda['LT59:StartStop_RBV'] = monitored('LT59:StartStop_RBV')
+
+        # Retrieve in the background, the monitored readbacks above follow
+        self.sample_slowly('temperature', 'LT59:Temp1', self.retrieve)
+
+    def retrieve(self):
+        """ Have the controller send its readbacks, return the temperature """
+        put_and_wait('LT59:Retrieve', 1)
+        return(float(pv_cache.get('LT59:Temp1_RBV')))
 
     def is_ready_p(self):
         return(True)
@@ -881,24 +2845,48 @@ class SuperCool(Cool_device):
 
 class ECatEL3318(Cool_device):
     dev_type = 'm-ethercat with EL3318'
+    ethercat = '/home/dev/git/m-ethercat/ethercat-1.5.2/tool/ethercat'
+    n_channels = 8
+    interval = 1.0  # Seconds between reads of all channels, see slow_control
 
-    def get_temp(self, channel, position):
+    def read_all(self):
+        """
+        Temperatures of all channels. The ethercat tool uploads one object
+        per call, so this still starts one ethercat process per channel, from
+        a single shell. Channels that fail to read are nan.
+        """
+        script = ' '.join('{0} upload -p{1:d} --type int16 0x60{2:d}0 0x11 || echo - nan;'.format(
+            self.ethercat, self.position, n) for n in range(self.n_channels))
+        output = subprocess.check_output(['sh', '-c', script]).split(b'\n')
+        return([int(line.split()[1])/10.0 if line.split()[1:] != [b'nan'] else float('nan')
+                for line in output[:self.n_channels]])
+
+    def get_temp(self, channel):
+        """
+        Latest temperature of channel (1 to 8), read now if there is none.
+        nan for channel 0, before move_to_sample picked a channel.
+        """
         if channel == -1:
             return(0.0)
-        else:
-            output = subprocess.check_output(['/home/dev/git/m-ethercat/ethercat-1.5.2/tool/ethercat',
-                                              'upload',
-                                              '-p{:d}'.format(position),
-                                              '--type',
-                                              'int16',
-                                              '0x60{:d}0'.format(channel - 1),
-                                              '0x11'])
-            return(int(output.split()[1])/10.0)
+        if channel == 0:
+            return(float('nan'))
+        if not 1 <= channel <= self.n_channels:
+            raise ValueError('EL3318 channel must be 1 to ' + str(self.n_channels) + ', not ' + str(channel))
+        return(slow_control.value(self.readback)[channel - 1])
+
+    def temp_age(self):
+        """ Seconds since the temperatures were read """
+        return(slow_control.age(self.readback))
 
     def __init__(self, position):
         self.port = 'ECAT'
         super().__init__('ECAT', 'data/temperature/ECAT/', self.dev_type, None)
         self.triggercount = 0
+        self.position = position
+        # All channels are read together in the background while connected
+        self.readback = 'ECAT:' + str(position) + ':temperatures'
+        slow_control.register(self.readback, self.read_all, self.interval)
+        self.slow_readbacks.append(self.readback)
 
         self.sample_dict = {}
         self.sample_name = ''
@@ -907,7 +2895,8 @@ class ECatEL3318(Cool_device):
         sda = self.savedata.attrs
         sda['slave_position'] = position
         sda['channel'] = lambda: self.channel
-        sda['temperature'] = lambda: self.get_temp(self.channel, position)
+        sda['temperature'] = lambda: self.get_temp(self.channel)
+        sda['temperature_age'] = lambda: self.temp_age()
 
     def add_sample(self, name, channel):
         self.sample_dict[name] = channel
@@ -921,11 +2910,37 @@ class ECatEL3318(Cool_device):
         return(True)
 
 
+class SlowControl(Cool_device):
+    """
+    History of the slow_control readbacks, e.g. temperature and position
+    trends in heat scans. Every event gets the samples taken since the
+    previous event; run files append them to one time series per readback.
+    """
+    dev_type = 'Slow control history'
+
+    def __init__(self, names=None):
+        """ Stream names, or every readback registered so far """
+        super().__init__('SLOW', 'data/slow_control/', self.dev_type, None)
+        self._counts = {}  # Name -> history rows already written
+        for name in (names or list(slow_control.readbacks)):
+            ds = Dataset(name.replace('/', '_'), lambda name=name: self.new_rows(name), stream=True)
+            ds.attrs['columns'] = 'time, value'
+            self.savedata.add_dataset(ds)
+
+    def new_rows(self, name):
+        rows, self._counts[name] = slow_control.history[name].since(self._counts.get(name, 0))
+        return(rows)
+
+    def is_ready_p(self):
+        return(True)
+
+
 class Raspi_trigger(Cool_device):
     """
     Raspberry pi trigger on demand over sockets
     """
     dev_type = "Raspi trigger"
+    trigger_rank = 2  # Counts the triggers it sends, the preferred reference
 
     def __init__(self, dev_port="RPI"):
         """ Initialize pm100 """
@@ -933,10 +2948,19 @@ class Raspi_trigger(Cool_device):
                          'data/trigger/' + dev_port + '/',
                          self.dev_type,
                          None)
+        self._trigger_num = monitored(dev_port + ':getTriggerNum')
+        # Trigger times for numbering readouts in event_match='count', see count_at
+        self.trigger_times = RingBuffer(1024)
+        pv_cache.pv(dev_port + ':getTriggerNum').add_callback(self.on_trigger_num)
 
     def get_glob_trigger(self):
-        return(int(epics.caget("RPI:getTriggerNum")))
-        
+        return(self.trigger_number())
+
+    def trigger_number(self):
+        return(int(self._trigger_num()))
+
+    def on_trigger_num(self, value=None, timestamp=None, **kw):
+        self.trigger_times.append(timestamp, value)
 
     def hw_trigger(self):
         print("Raspi will trigger!")
@@ -955,6 +2979,9 @@ class PM100(Cool_device):
     n_samples = 10
 
     times = []
+    array_data = []
+    scan_rate = 9  # SCAN .1 second while sampling
+    trigger_time = 0.0  # Of the current event, continuous mode
 
     def populate(self):
         """ Fill a list of PM values with timestamps, sample for 10 seconds """
@@ -975,14 +3002,72 @@ class PM100(Cool_device):
         self.times = [a[1] for a in pmvals]
         # We are done and ready for read out
         self.is_ready = True
+        self.notify_ready()
 
     def sw_trigger(self):
         "Trigger starts data collection thread"
-        if(not self.is_ready):
+        if self.continuous:
+            self.mark_trigger()
+        elif(not self.is_ready):
             threading.Thread(target=self.populate, args=()).start()
 
-    def __init__(self, port, sw_trig=False):
-        """ Initialize pm100 """
+    def hw_trigger(self):
+        """ Not a trigger generator, but the trigger time is needed in continuous mode """
+        if self.continuous:
+            self.mark_trigger()
+
+    def mark_trigger(self):
+        self.trigger_times.append(time.time())
+
+    def on_power(self, value=None, **kw):
+        """ Monitor callback in continuous mode: store the sample, see if a trigger window is complete """
+        now = time.time()
+        self.ring.append(now, value)
+        if self.trigger_times and not self.is_ready and now >= self.trigger_times[0] + self.window[1]:
+            self.is_ready = True
+            self.notify_ready()
+
+    def connect(self):
+        if self.continuous and self.connections == 0:
+            self._scan_mode = epics.caget(self.port + ':MEAS:POW.SCAN')
+            epics.caput(self.port + ':MEAS:POW.SCAN', self.scan_rate)
+            pv = epics.PV(self.pm_pv, auto_monitor=True,
+                          callback=lambda pvname=None, value=None, **fw: self.on_power(value))
+            self.connected_pvs.append(pv)
+        return(super().connect())
+
+    def disconnect(self):
+        super().disconnect()
+        if self.continuous and self.connections == 0 and self._scan_mode is not None:
+            epics.caput(self.port + ':MEAS:POW.SCAN', self._scan_mode)
+            self._scan_mode = None
+
+    def is_ready_p(self):
+        if self.continuous and self.trigger_times and not self.is_ready:
+            # No monitor update after the window, e.g. the power did not change
+            if time.time() >= self.trigger_times[0] + self.window[1] + 1.0:
+                self.is_ready = True
+        return(self.is_ready)
+
+    def clear(self):
+        super().clear()
+        self.trigger_times.clear()
+
+    def advance(self):
+        """ Move on to the next trigger window, if it is complete already """
+        super().advance()
+        if self.continuous and self.trigger_times:
+            self.trigger_times.popleft()
+            if self.trigger_times and (self.ring.latest() or 0) >= self.trigger_times[0] + self.window[1]:
+                self.is_ready = True
+
+    def __init__(self, port, sw_trig=False, continuous=False, window=(-0.5, 0.5), buffer_size=2**16):
+        """
+        Initialize pm100. By default every trigger samples the power for
+        capture_time seconds. With continuous, the power is sampled all the
+        time into a ring buffer, and each event gets the samples within
+        window (seconds, relative to the trigger time).
+        """
         super().__init__(port,
                          'data/powermeter/' + port + '/',
                          self.dev_type,
@@ -990,8 +3075,17 @@ class PM100(Cool_device):
         self.capture_time = 10
         self.port = port
         self.pm_pv = self.port + ':MEAS:POW'
-        self.savedata.attrs['acquire_duration'] = self.capture_time
-        self.savedata.attrs['wavelength'] = lambda: epics.caget("PM100:SENS:CORR:WAV_RBV")
+        self.continuous = continuous
+        self.window = window
+        self.ring = RingBuffer(buffer_size)
+        self.trigger_times = collections.deque()  # Triggers waiting for readout, continuous mode
+        self._scan_mode = None
+        if continuous:
+            self.savedata.attrs['acquire_duration'] = window[1] - window[0]
+            self.savedata.attrs['trigger_time'] = lambda: self.trigger_time
+        else:
+            self.savedata.attrs['acquire_duration'] = self.capture_time
+        self.savedata.attrs['wavelength'] = monitored("PM100:SENS:CORR:WAV_RBV")
 
         # Saving data
         x_data = Dataset('x_values', lambda: self.times)
@@ -1005,8 +3099,12 @@ class PM100(Cool_device):
         y_data.attrs['pvname'] = self.pm_pv
         self.savedata.add_dataset(y_data)
 
-    def write(self, h5f):
+    def snapshot(self):
         # We must trigger an uptade to WAV_RBV before the PV is written to file
-        epics.caput(self.port + ':SENS:CORR:WAV_RBV.PROC', 1)
-        time.sleep(0.01)
-        super().write(h5f)
+        self.wait_for_put(self.port + ':SENS:CORR:WAV_RBV.PROC', 1)
+        if self.continuous:
+            self.trigger_time = self.trigger_times[0] if self.trigger_times else time.time()
+            rows = self.ring.window(self.trigger_time + self.window[0], self.trigger_time + self.window[1])
+            self.times = rows[:, 0]
+            self.array_data = rows[:, 1]
+        return(super().snapshot())
@@ -0,0 +1,28 @@
+import data_coolection as cool
+import sys
+import time
+import matplotlib.pyplot as plt
+
+# Follow a run file written with Coolector(file_layout='run', swmr=True),
+# plot camera frames as soon as they are flushed, e.g.
+# python live-viewer.py /var/data/ocl/2019-05-22/run-20190522-101500.h5 data/images/CAM1/data
+
+fname = sys.argv[1]
+dsname = sys.argv[2] if len(sys.argv) > 2 else 'data/images/CAM1/data'
+
+fig = plt.figure()
+ax = fig.add_subplot(111)
+
+with cool.RunFileReader(fname) as reader:
+    while(True):
+        indices = reader.new_events()
+        if len(indices) > 0:
+            # Only the latest frame is plotted
+            image = reader.read(dsname, indices[-1])
+            print('Trigger ' + str(indices[-1]) + ', max ' + str(image.max()))
+            ax.clear()
+            ax.matshow(image)
+            plt.draw()
+            plt.pause(0.01)
+        else:
+            time.sleep(0.1)